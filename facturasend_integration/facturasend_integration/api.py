@@ -2,11 +2,31 @@
 # For license information, please see license.txt
 
 import frappe
-import requests
 import json
+import logging
+import time
+import traceback
 from frappe import _
-from datetime import datetime
-from frappe.utils import get_datetime, now_datetime, getdate
+from frappe.utils import add_to_date, cint, get_datetime, now_datetime
+from facturasend_integration.facturasend_integration.client import get_client, get_stats
+from facturasend_integration.facturasend_integration.converter import convert_documents
+from facturasend_integration.facturasend_integration.kude import enqueue_kude_prefetch, get_document_cdcs, get_kude_file
+from facturasend_integration.facturasend_integration.logger import get_logger
+from facturasend_integration.facturasend_integration.settings import get_facturasend_settings
+from facturasend_integration.facturasend_integration.send_queue import (
+	QUEUE_DONE,
+	QUEUE_ERROR,
+	QUEUE_PENDING,
+	QUEUE_POLLING,
+	QUEUE_SENDING,
+	QUEUE_DOCTYPE,
+	SENDING_LEASE_SECONDS,
+	bulk_update_records,
+	claim_entries,
+	enqueue_for_send,
+	get_send_retry,
+	release_entries
+)
 
 
 @frappe.whitelist()
@@ -17,13 +37,15 @@ def reset_document_retries(documents):
 		documents = json.loads(documents)
 	
 	try:
-		for doc_info in documents:
-			doc = frappe.get_doc("Sales Invoice", doc_info['name'])
-			doc.facturasend_reintentos = 0
-			doc.facturasend_estado = "Pendiente"
-			doc.facturasend_mensaje_estado = "Reintentos reseteados - Listo para reenviar"
-			doc.save(ignore_permissions=True)
-		
+		bulk_update_invoice_states({
+			doc_info['name']: {
+				"facturasend_reintentos": 0,
+				"facturasend_estado": "Pendiente",
+				"facturasend_mensaje_estado": "Reintentos reseteados - Listo para reenviar"
+			}
+			for doc_info in documents
+		}, commit=False)
+		bulk_update_records(QUEUE_DOCTYPE, {doc_info['name']: {"attempts": 0} for doc_info in documents})
 		frappe.db.commit()
 		
 		return {
@@ -52,17 +74,14 @@ def preview_facturasend_payload(documents):
 		batch_data = []
 		errors = []
 		
-		for doc_info in documents:
-			try:
-				doc = frappe.get_doc("Sales Invoice", doc_info['name'])
-				fs_data = convert_document_to_facturasend(doc, settings)
-				if fs_data:
-					batch_data.append(fs_data)
-				else:
-					errors.append(f"{doc.name}: Conversión retornó None")
-			except Exception as e:
-				errors.append(f"{doc.name}: {str(e)}")
-				frappe.log_error(frappe.get_traceback(), f"Preview Error {doc.name}")
+		docs = [frappe.get_doc("Sales Invoice", doc_info['name']) for doc_info in documents]
+		converted = convert_documents(docs, settings)
+		
+		for doc in docs:
+			if doc.name in converted.payloads:
+				batch_data.append(converted.payloads[doc.name])
+			else:
+				errors.append(f"{doc.name}: {converted.errors[doc.name]}")
 		
 		return {
 			"success": True,
@@ -81,107 +100,186 @@ def preview_facturasend_payload(documents):
 
 
 @frappe.whitelist()
-def get_pending_documents(tipo_documento=None, desde_fecha=None, hasta_fecha=None):
-	"""Obtiene lista de documentos pendientes de enviar a FacturaSend"""
+def get_api_client_stats():
+	"""Contadores de latencia por endpoint del cliente HTTP, de todos los workers"""
 	
-	doctypes = []
-	if tipo_documento:
-		doctypes = [tipo_documento]
-	else:
-		doctypes = ["Sales Invoice", "Sales Invoice", "Sales Invoice"]  # Credit Note y Debit Note son is_return en Sales Invoice
+	frappe.only_for("System Manager")
 	
-	documents = []
+	return get_stats()
+
+
+# Campos que se leen de Sales Invoice para listar documentos en la cola
+PENDING_DOCUMENT_FIELDS = [
+	"name", "customer", "customer_name", "posting_date", "grand_total", "currency",
+	"is_return", "is_debit_note", "facturasend_cdc", "facturasend_estado",
+	"facturasend_mensaje_estado", "facturasend_lote_id"
+]
+
+# Cantidad de documentos por página cuando no se indica un límite
+DEFAULT_PAGE_LENGTH = 500
+
+
+@frappe.whitelist()
+def get_pending_documents(tipo_documento=None, desde_fecha=None, hasta_fecha=None, limit=None, offset=0):
+	"""Obtiene lista de documentos pendientes de enviar a FacturaSend
 	
-	# Sales Invoices (facturas normales)
-	if not tipo_documento or tipo_documento == "Sales Invoice":
-		filters = [
-			["Sales Invoice", "docstatus", "=", 1],
-			["Sales Invoice", "is_return", "=", 0]
-		]
-		
-		if desde_fecha:
-			filters.append(["Sales Invoice", "posting_date", ">=", desde_fecha])
-		if hasta_fecha:
-			filters.append(["Sales Invoice", "posting_date", "<=", hasta_fecha])
-		
-		try:
-			invoices = frappe.get_all("Sales Invoice",
-				filters=filters,
-				fields=["name", "customer", "customer_name", "posting_date", "grand_total", 
-				        "currency"],
-				order_by="posting_date desc"
-			)
-			
-			# Obtener campos personalizados por separado para evitar errores si no existen
-			for inv in invoices:
-				inv['doctype'] = 'Sales Invoice'
-				
-				# Intentar obtener campos FacturaSend de forma segura
-				try:
-					doc = frappe.get_doc("Sales Invoice", inv.name)
-					inv['facturasend_cdc'] = getattr(doc, 'facturasend_cdc', None)
-					inv['facturasend_estado'] = getattr(doc, 'facturasend_estado', None)
-					inv['facturasend_mensaje_estado'] = getattr(doc, 'facturasend_mensaje_estado', None)
-					inv['facturasend_lote_id'] = getattr(doc, 'facturasend_lote_id', None)
-				except:
-					inv['facturasend_cdc'] = None
-					inv['facturasend_estado'] = None
-					inv['facturasend_mensaje_estado'] = None
-					inv['facturasend_lote_id'] = None
-				
-				documents.append(inv)
-		except Exception as e:
-			frappe.log_error(frappe.get_traceback(), "Error obteniendo Sales Invoices")
-			frappe.throw(_(f"Error obteniendo facturas: {str(e)}"))
-	
-	# Credit Notes
-	if not tipo_documento or tipo_documento == "Credit Note":
-		filters = [
-			["Sales Invoice", "docstatus", "=", 1],
-			["Sales Invoice", "is_return", "=", 1],
-			["Sales Invoice", "is_debit_note", "=", 0]
-		]
-		if desde_fecha:
-			filters.append(["Sales Invoice", "posting_date", ">=", desde_fecha])
-		if hasta_fecha:
-			filters.append(["Sales Invoice", "posting_date", "<=", hasta_fecha])
-		
-		credit_notes = frappe.get_all("Sales Invoice",
-			filters=filters,
-			fields=["name", "customer", "customer_name", "posting_date", "grand_total", 
-			        "currency", "facturasend_cdc", "facturasend_estado", 
-			        "facturasend_mensaje_estado", "facturasend_lote_id"]
-		)
-		
-		for cn in credit_notes:
-			cn['doctype'] = 'Credit Note'
-			documents.append(cn)
-	
-	# Debit Notes
-	if not tipo_documento or tipo_documento == "Debit Note":
-		filters = [
-			["Sales Invoice", "docstatus", "=", 1],
-			["Sales Invoice", "is_debit_note", "=", 1]
-		]
-		if desde_fecha:
-			filters.append(["Sales Invoice", "posting_date", ">=", desde_fecha])
-		if hasta_fecha:
-			filters.append(["Sales Invoice", "posting_date", "<=", hasta_fecha])
-		
-		debit_notes = frappe.get_all("Sales Invoice",
+	Facturas, notas de crédito y notas de débito se obtienen en una sola
+	consulta paginada, con los campos FacturaSend seleccionados directamente.
+	"""
+	
+	filters = get_queue_filters(tipo_documento, desde_fecha=desde_fecha, hasta_fecha=hasta_fecha)
+	
+	try:
+		documents = frappe.get_all("Sales Invoice",
 			filters=filters,
-			fields=["name", "customer", "customer_name", "posting_date", "grand_total", 
-			        "currency", "facturasend_cdc", "facturasend_estado", 
-			        "facturasend_mensaje_estado", "facturasend_lote_id"]
+			fields=PENDING_DOCUMENT_FIELDS,
+			order_by="posting_date desc, name desc",
+			limit_start=cint(offset),
+			limit_page_length=cint(limit) or DEFAULT_PAGE_LENGTH
 		)
-		
-		for dn in debit_notes:
-			dn['doctype'] = 'Debit Note'
-			documents.append(dn)
+	except Exception as e:
+		frappe.log_error(frappe.get_traceback(), "Error obteniendo Sales Invoices")
+		frappe.throw(_(f"Error obteniendo facturas: {str(e)}"))
+	
+	for doc in documents:
+		doc['doctype'] = get_document_type(doc)
 	
 	return documents
 
 
+def get_document_type_filters(tipo_documento=None):
+	"""Filtros de Sales Invoice según el tipo de documento (factura, nota de crédito o débito)"""
+	
+	filters = [["Sales Invoice", "docstatus", "=", 1]]
+	
+	if tipo_documento == "Sales Invoice":
+		filters.append(["Sales Invoice", "is_return", "=", 0])
+		filters.append(["Sales Invoice", "is_debit_note", "=", 0])
+	elif tipo_documento == "Credit Note":
+		filters.append(["Sales Invoice", "is_return", "=", 1])
+		filters.append(["Sales Invoice", "is_debit_note", "=", 0])
+	elif tipo_documento == "Debit Note":
+		filters.append(["Sales Invoice", "is_debit_note", "=", 1])
+	
+	return filters
+
+
+def get_document_type(doc):
+	"""Tipo de documento de la cola para una fila de Sales Invoice"""
+	
+	if doc.get('is_debit_note'):
+		return 'Debit Note'
+	if doc.get('is_return'):
+		return 'Credit Note'
+	return 'Sales Invoice'
+
+
+# Tamaño de página por defecto para la grilla de la cola
+QUEUE_PAGE_LENGTH = 100
+
+
+@frappe.whitelist()
+def get_queue_page(tipo_documento=None, estado=None, customer=None, desde_fecha=None,
+		hasta_fecha=None, cursor=None, page_length=QUEUE_PAGE_LENGTH):
+	"""Obtiene una página de documentos para la grilla de FacturaSend Queue
+	
+	Usa paginación por cursor sobre (posting_date, name) descendente, de modo que
+	cada página cuesta lo mismo sin importar cuántos documentos haya antes.
+	En la primera página (sin cursor) también retorna la cantidad por estado.
+	"""
+	
+	if isinstance(cursor, str):
+		cursor = json.loads(cursor) if cursor else None
+	
+	page_length = min(cint(page_length) or QUEUE_PAGE_LENGTH, DEFAULT_PAGE_LENGTH)
+	
+	filters = get_queue_filters(tipo_documento, customer, desde_fecha, hasta_fecha)
+	page_filters = filters + get_estado_filters(estado)
+	or_filters = []
+	
+	if cursor:
+		# (posting_date, name) < cursor  ==  posting_date <= fecha AND (posting_date < fecha OR name < nombre)
+		page_filters.append(["Sales Invoice", "posting_date", "<=", cursor['posting_date']])
+		or_filters = [
+			["Sales Invoice", "posting_date", "<", cursor['posting_date']],
+			["Sales Invoice", "name", "<", cursor['name']]
+		]
+	
+	documents = frappe.get_all("Sales Invoice",
+		filters=page_filters,
+		or_filters=or_filters,
+		fields=PENDING_DOCUMENT_FIELDS,
+		order_by="posting_date desc, name desc",
+		limit_page_length=page_length + 1
+	)
+	
+	has_more = len(documents) > page_length
+	documents = documents[:page_length]
+	
+	for doc in documents:
+		doc['doctype'] = get_document_type(doc)
+	
+	next_cursor = None
+	if has_more and documents:
+		next_cursor = {
+			"posting_date": str(documents[-1].posting_date),
+			"name": documents[-1].name
+		}
+	
+	result = {
+		"documents": documents,
+		"next_cursor": next_cursor
+	}
+	
+	if not cursor:
+		result["counts"] = get_estado_counts(filters)
+	
+	return result
+
+
+def get_queue_filters(tipo_documento=None, customer=None, desde_fecha=None, hasta_fecha=None):
+	"""Filtros de la grilla de la cola, sin incluir el estado FacturaSend"""
+	
+	filters = get_document_type_filters(tipo_documento)
+	if customer:
+		filters.append(["Sales Invoice", "customer", "=", customer])
+	if desde_fecha:
+		filters.append(["Sales Invoice", "posting_date", ">=", desde_fecha])
+	if hasta_fecha:
+		filters.append(["Sales Invoice", "posting_date", "<=", hasta_fecha])
+	
+	return filters
+
+
+def get_estado_filters(estado=None):
+	"""Filtro por estado FacturaSend; "Pendiente" incluye documentos sin estado"""
+	
+	if not estado:
+		return []
+	
+	if estado == "Pendiente":
+		return [["Sales Invoice", "facturasend_estado", "in", ["", "Pendiente"]]]
+	
+	return [["Sales Invoice", "facturasend_estado", "=", estado]]
+
+
+def get_estado_counts(filters):
+	"""Cantidad de documentos por estado FacturaSend en una sola consulta agrupada"""
+	
+	rows = frappe.get_all("Sales Invoice",
+		filters=filters,
+		fields=["facturasend_estado", "count(name) as count"],
+		group_by="facturasend_estado"
+	)
+	
+	counts = {}
+	for row in rows:
+		estado = row.facturasend_estado or "Pendiente"
+		counts[estado] = counts.get(estado, 0) + row.count
+	
+	return counts
+
+
 @frappe.whitelist()
 def send_batch_to_facturasend(documents):
 	"""Envía un lote de documentos a FacturaSend"""
@@ -204,482 +302,329 @@ def send_batch_to_facturasend(documents):
 	try:
 		settings = get_facturasend_settings()
 		
-		# Preparar datos para FacturaSend
-		batch_data = []
-		conversion_errors = []
+		# Pasar por la cola, así otro worker no puede enviar los mismos documentos
+		enqueue_for_send(documents)
 		
-		frappe.log_error(f"Procesando {len(documents)} documentos: {[d['name'] for d in documents]}", "FacturaSend Batch Processing")
-		
-		for doc_info in documents:
-			doc = frappe.get_doc("Sales Invoice", doc_info['name'])
-			
-			# Verificar si ya está aprobado (no reintentar documentos exitosos)
-			if doc.facturasend_estado == "Aprobado":
-				error_msg = f"{doc.name}: Ya está aprobado en FacturaSend"
-				conversion_errors.append(error_msg)
-				frappe.log_error(error_msg, "FacturaSend Skip Document")
-				continue
-			
-			# Verificar reintentos solo si tiene error
-			if doc.facturasend_estado == "Error" and doc.facturasend_reintentos and doc.facturasend_reintentos >= settings.max_retries:
-				error_msg = f"{doc.name}: Máximo de reintentos alcanzado ({doc.facturasend_reintentos}/{settings.max_retries})"
-				conversion_errors.append(error_msg)
-				frappe.log_error(error_msg, "FacturaSend Skip Document")
-				continue
-			
-			# Convertir documento a formato FacturaSend
-			try:
-				frappe.log_error(f"Convirtiendo {doc.name} (estado: {doc.facturasend_estado}, reintentos: {doc.facturasend_reintentos})", "FacturaSend Converting")
-				fs_data = convert_document_to_facturasend(doc, settings)
-				if fs_data:
-					batch_data.append(fs_data)
-					frappe.log_error(f"{doc.name} convertido exitosamente", "FacturaSend Converted OK")
-				else:
-					conversion_errors.append(f"{doc.name}: Conversión retornó None")
-			except Exception as e:
-				error_msg = f"{doc.name}: {str(e)}"
-				conversion_errors.append(error_msg)
-				frappe.log_error(frappe.get_traceback(), f"Error convirtiendo {doc.name}")
-		
-		frappe.log_error(f"Resultado: {len(batch_data)} documentos listos para enviar, {len(conversion_errors)} errores", "FacturaSend Batch Summary")
-		
-		if not batch_data:
-			error_detail = "\n".join(conversion_errors) if conversion_errors else "Razón desconocida"
-			# Guardar en log Y retornar al usuario
-			frappe.log_error(error_detail, "FacturaSend Conversion Errors")
-			return {"success": False, "error": f"No hay documentos válidos para enviar", "details": conversion_errors}
+		lote = prepare_lote(documents, settings)
+		if not lote.batch_data:
+			return complete_empty_lote(lote)
 		
 		# Enviar a FacturaSend API
-		response = send_to_facturasend_api(batch_data, settings)
+		response = send_to_facturasend_api(lote.batch_data, settings)
 		
-		if response.get('success'):
-			# Crear log
-			log = create_facturasend_log(response, documents, tipo)
-			
-			# Actualizar documentos
-			update_documents_after_send(documents, response, log.name)
-			
-			# Obtener CDCs de los documentos enviados
-			cdcs = []
-			de_list = response['result'].get('deList', [])
-			for i, doc_info in enumerate(documents):
-				if i < len(de_list):
-					cdc = de_list[i].get('cdc', '')
-					if cdc:
-						cdcs.append(cdc)
-			
-			return {
-				"success": True, 
-				"lote_id": response['result'].get('loteId'),
-				"log_name": log.name,
-				"cdcs": cdcs,
-				"document_names": [doc['name'] for doc in documents]
-			}
-		else:
-			# Actualizar documentos con error
-			for doc_info in documents:
-				doc = frappe.get_doc("Sales Invoice", doc_info['name'])
-				
-				# Solo incrementar reintentos si ya tenía estado de error
-				if doc.facturasend_estado == "Error":
-					doc.facturasend_reintentos = (doc.facturasend_reintentos or 0) + 1
-				else:
-					doc.facturasend_reintentos = 1
-				
-				doc.facturasend_estado = "Error"
-				doc.facturasend_mensaje_estado = response.get('error', 'Error desconocido')
-				doc.save(ignore_permissions=True)
-			
-			frappe.db.commit()
-			
-			# Enviar notificación de error
-			send_error_notification(documents, response.get('error'))
-			
-			return {"success": False, "error": response.get('error')}
+		return complete_lote(lote, response)
 			
 	except Exception as e:
 		frappe.log_error(frappe.get_traceback(), "FacturaSend - Error al enviar lote")
 		return {"success": False, "error": str(e)}
 
 
-def convert_document_to_facturasend(doc, settings):
-	"""Convierte un documento de ERPNext al formato requerido por FacturaSend"""
+def prepare_lote(documents, settings, owned_by=None):
+	"""Reserva, carga y convierte los documentos de un lote (todos del mismo tipo)
+	
+	Solo se procesan los documentos cuya entrada de la cola se pudo reservar
+	(pendientes y no tomados por otro worker, salvo `owned_by`). Al
+	reservarlas pasan a Enviando, estado que el envío programado no toma, así
+	un envío lento nunca se repite. Retorna un diccionario con el
+	tipo, los documentos cargados, el JSON a enviar (`batch_data`), los
+	documentos incluidos en él (`sent_documents`, en el mismo orden), los
+	errores de conversión y las entradas de la cola a liberar (`queue_updates`).
+	Si algo falla antes del envío, las entradas reservadas vuelven enseguida
+	a Pendiente.
+	"""
+	
+	conversion_errors = []
+	
+	get_logger().info(f"Procesando {len(documents)} documentos: {[d['name'] for d in documents]}")
+	
+	claimed = {
+		entry.name
+		for entry in claim_entries(
+			QUEUE_PENDING,
+			names=[d['name'] for d in documents],
+			owned_by=owned_by,
+			new_state=QUEUE_SENDING,
+			lease_seconds=SENDING_LEASE_SECONDS
+		)
+	}
+	for doc_info in documents:
+		if doc_info['name'] not in claimed:
+			conversion_errors.append(f"{doc_info['name']}: Ya se está enviando en otro proceso")
 	
 	try:
-		frappe.log_error(f"Iniciando conversión de {doc.name}", "FacturaSend Conversion Debug")
-		
-		# Determinar tipo de documento
-		tipo_documento = 1  # Factura
-		if doc.is_return and not doc.is_debit_note:
-			tipo_documento = 5  # Nota de Crédito
-		elif doc.is_debit_note:
-			tipo_documento = 4  # Nota de Débito
-		
-		# Extraer establecimiento y punto de la serie
-		establecimiento, punto = extract_establecimiento_punto(doc.name, settings)
-		
-		# Obtener datos del cliente
-		customer = frappe.get_doc("Customer", doc.customer)
-		
-		# Obtener contacto principal del cliente
-		contact = get_customer_primary_contact(customer.name)
-		
-		# Preparar datos del cliente
-		# Convertir contribuyente a boolean
-		es_contribuyente = customer.get("facturasend_contribuyente", 1) == 1 or customer.get("facturasend_contribuyente", 1) == True
-		
-		# Generar código del cliente (3-15 caracteres)
-		# Si es contribuyente, usar RUC sin guión
-		# Si no, usar hash del nombre o documento
-		if es_contribuyente and customer.get("facturasend_ruc"):
-			codigo_cliente = customer.get("facturasend_ruc", "").replace("-", "")[:15]
-		elif customer.get("facturasend_documento_numero"):
-			codigo_cliente = customer.get("facturasend_documento_numero", "")[:15]
+		return build_lote(documents, claimed, settings, conversion_errors)
+	except Exception:
+		# Nada llegó a FacturaSend: no esperar a que venza la reserva de Enviando
+		frappe.db.rollback()
+		release_entries({name: {"state": QUEUE_PENDING} for name in claimed})
+		raise
+
+
+def build_lote(documents, claimed, settings, conversion_errors):
+	"""Carga y convierte los documentos reservados (`claimed`) de un lote
+	
+	Ver `prepare_lote`.
+	"""
+	
+	tipo = documents[0]['doctype']
+	
+	# Preparar datos para FacturaSend
+	batch_data = []
+	sent_documents = []
+	queue_updates = {}
+	
+	docs = [frappe.get_doc("Sales Invoice", doc_info['name']) for doc_info in documents if doc_info['name'] in claimed]
+	to_convert = []
+	
+	for doc in docs:
+		# Verificar si ya está aprobado (no reintentar documentos exitosos)
+		if doc.facturasend_estado == "Aprobado":
+			error_msg = f"{doc.name}: Ya está aprobado en FacturaSend"
+			conversion_errors.append(error_msg)
+			queue_updates[doc.name] = {"state": QUEUE_DONE}
+			get_logger().warning(error_msg)
+			continue
+		
+		# Verificar reintentos solo si tiene error
+		if doc.facturasend_estado == "Error" and doc.facturasend_reintentos and doc.facturasend_reintentos >= settings.max_retries:
+			error_msg = f"{doc.name}: Máximo de reintentos alcanzado ({doc.facturasend_reintentos}/{settings.max_retries})"
+			conversion_errors.append(error_msg)
+			queue_updates[doc.name] = {"state": QUEUE_ERROR, "last_error": error_msg}
+			get_logger().warning(error_msg)
+			continue
+		
+		to_convert.append(doc)
+	
+	# Convertir documentos a formato FacturaSend
+	converted = convert_documents(to_convert, settings)
+	
+	for doc in to_convert:
+		if doc.name in converted.payloads:
+			batch_data.append(converted.payloads[doc.name])
+			sent_documents.append({"doctype": tipo, "name": doc.name})
 		else:
-			# Usar hash del nombre (primeros 10 caracteres)
-			import hashlib
-			codigo_cliente = hashlib.md5(customer.name.encode()).hexdigest()[:10]
-		
-		cliente_data = {
-			"contribuyente": es_contribuyente,  # Boolean, no int
-			"razonSocial": customer.customer_name,
-			"nombreFantasia": customer.get("facturasend_nombre_fantasia") or customer.customer_name,
-			"tipoOperacion": extract_number(customer.get("facturasend_tipo_operacion", "1")),
-			"pais": customer.get("facturasend_pais", "PRY"),
-			"paisDescripcion": customer.get("facturasend_pais_desc", "Paraguay"),
-			"tipoContribuyente": extract_number(customer.get("facturasend_tipo_contribuyente", "1")),
-			"telefono": contact.get("phone", "") if contact else "",
-			"celular": contact.get("mobile_no", "") if contact else "",
-			"email": contact.get("email_id", "") if contact else "",
-			"codigo": codigo_cliente
-		}
-		
-		# documentoTipo y documentoNumero solo si NO es contribuyente
-		if not es_contribuyente:
-			cliente_data["documentoTipo"] = extract_number(customer.get("facturasend_documento_tipo", "1"))
-			cliente_data["documentoNumero"] = customer.get("facturasend_documento_numero", "")
-		
-		# Agregar RUC si es contribuyente
-		if es_contribuyente:
-			cliente_data["ruc"] = customer.get("facturasend_ruc", "")
-		
-		# Agregar dirección SOLO si tienes ciudad y distrito (campos obligatorios)
-		# Si tipoOperacion != 4, ciudad y distrito son obligatorios
-		tiene_ciudad = customer.get("facturasend_ciudad")
-		tiene_distrito = customer.get("facturasend_distrito")
+			error = converted.errors[doc.name]
+			conversion_errors.append(f"{doc.name}: {error}")
+			queue_updates[doc.name] = {"state": QUEUE_ERROR, "last_error": error}
+	
+	get_logger().info(f"Resultado: {len(batch_data)} documentos listos para enviar, {len(conversion_errors)} errores")
+	
+	return frappe._dict({
+		"tipo": tipo,
+		"docs": docs,
+		"batch_data": batch_data,
+		"sent_documents": sent_documents,
+		"conversion_errors": conversion_errors,
+		"queue_updates": queue_updates
+	})
+
+
+def complete_empty_lote(lote):
+	"""Libera la cola y arma el resultado de un lote sin documentos para enviar"""
+	
+	release_entries(lote.queue_updates)
+	
+	error_detail = "\n".join(lote.conversion_errors) if lote.conversion_errors else "Razón desconocida"
+	# Guardar en log Y retornar al usuario
+	get_logger().warning(f"Ningún documento válido para enviar:\n{error_detail}")
+	return {"success": False, "error": f"No hay documentos válidos para enviar", "details": lote.conversion_errors}
+
+
+def complete_lote(lote, response):
+	"""Registra el resultado del envío de un lote y actualiza sus documentos
+	
+	Los enviados con CDC pasan en la cola a consulta de estado. Si el envío
+	falló, se reintentan solos más tarde salvo que FacturaSend haya rechazado
+	los documentos (`errores`) o se hayan agotado los reintentos.
+	"""
+	
+	sent_documents = lote.sent_documents
+	queue_updates = lote.queue_updates
+	
+	# deList viene en el mismo orden que batch_data: usar solo los documentos enviados
+	if response.get('success'):
+		# Crear log
+		log = create_facturasend_log(response, sent_documents, lote.tipo)
 		
-		# Solo agregar dirección si tienes los campos mínimos requeridos
-		if tiene_ciudad and tiene_distrito:
-			address = get_customer_primary_address(customer.name)
-			if address:
-				address_line = address.get("address_line1", "")
-				if address.get("address_line2"):
-					address_line += " " + address.get("address_line2")
-				
-				if address_line:
-					cliente_data["direccion"] = address_line
-					cliente_data["numeroCasa"] = customer.get("facturasend_numero_casa", "0")  # Usar custom field o default "0"
-			
-			# Agregar ubicación (ahora sabemos que existen)
-			cliente_data["ciudad"] = tiene_ciudad
-			cliente_data["ciudadDescripcion"] = customer.get("facturasend_ciudad_desc", "")
-			cliente_data["distrito"] = tiene_distrito
-			cliente_data["distritoDescripcion"] = customer.get("facturasend_distrito_desc", "")
-			
-			# Departamento es opcional pero lo agregamos si existe
-			if customer.get("facturasend_departamento"):
-				cliente_data["departamento"] = customer.get("facturasend_departamento")
-				cliente_data["departamentoDescripcion"] = customer.get("facturasend_departamento_desc", "")
+		# Actualizar documentos
+		try:
+			updates = update_documents_after_send(sent_documents, response, log.name)
+		except frappe.db.IntegrityError:
+			# Otra factura guardó el mismo CDC entre la verificación y el UPDATE:
+			# se repite, y esta vez ese documento queda en error
+			frappe.db.rollback()
+			updates = update_documents_after_send(sent_documents, response, log.name)
+		
+		for name, values in updates.items():
+			if values.get('facturasend_cdc'):
+				queue_updates[name] = {"state": QUEUE_POLLING, "next_attempt": values['facturasend_proxima_consulta']}
+			else:
+				queue_updates[name] = {"state": QUEUE_ERROR, "last_error": values['facturasend_mensaje_estado']}
+		release_entries(queue_updates)
 		
-		# Si no tiene ciudad/distrito, NO enviar dirección ni ubicación
+		# Obtener CDCs de los documentos enviados
+		cdcs = []
+		de_list = response['result'].get('deList', [])
+		for i, doc_info in enumerate(sent_documents):
+			if i < len(de_list):
+				cdc = de_list[i].get('cdc', '')
+				if cdc:
+					cdcs.append(cdc)
 		
-		# Obtener datos del usuario
-		user = frappe.get_doc("User", doc.owner)
-		usuario_data = {
-			"documentoTipo": extract_number(user.get("facturasend_documento_tipo", "1")),
-			"documentoNumero": user.get("facturasend_documento_numero", "") or "",
-			"nombre": user.full_name,
-			"cargo": user.get("facturasend_cargo", "") or ""
+		return {
+			"success": True, 
+			"lote_id": response['result'].get('loteId'),
+			"log_name": log.name,
+			"cdcs": cdcs,
+			"document_names": [doc['name'] for doc in sent_documents]
 		}
-		
-		# Preparar items
-		items_data = []
-		for item in doc.items:
-			item_doc = frappe.get_doc("Item", item.item_code)
-			
-			# Determinar tipo de IVA
-			iva_tipo = 1  # 10%
-			iva_tasa = 10
-			if item.get("item_tax_template"):
-				# Aquí deberías mapear según tu configuración de impuestos
-				# Por ahora usamos valor por defecto
-				pass
-			
-			# Obtener barcode del item
-			barcode = item.item_code  # Default al código del item
-			
-			# Intentar obtener barcode de la tabla Item Barcode
-			if item_doc.barcodes and len(item_doc.barcodes) > 0:
-				barcode = item_doc.barcodes[0].barcode
-			
-			# Para PYG, no usar decimales
-			cantidad = item.qty
-			precio_unitario = item.rate
+	else:
+		# Actualizar documentos con error
+		settings = get_facturasend_settings()
+		retryable = not response.get('errores')
+		sent_names = {doc_info['name'] for doc_info in sent_documents}
+		updates = {}
+		for doc in lote.docs:
+			if doc.name not in sent_names:
+				continue
 			
-			if doc.currency == "PYG":
-				precio_unitario = int(round(item.rate))
+			# Solo incrementar reintentos si ya tenía estado de error
+			if doc.facturasend_estado == "Error":
+				reintentos = (doc.facturasend_reintentos or 0) + 1
+			else:
+				reintentos = 1
 			
-			item_data = {
-				"codigo": item.item_code,
-				"descripcion": item.description or item.item_name,
-				"unidadMedida": 77,  # Unidad por defecto
-				"cantidad": cantidad,
-				"precioUnitario": precio_unitario,
-				"cambio": 0.0,
-				"ivaTipo": iva_tipo,
-				"ivaBase": 100,
-				"iva": iva_tasa,
-				"extras": {
-					"barCode": barcode
-				}
+			updates[doc.name] = {
+				"facturasend_reintentos": reintentos,
+				"facturasend_estado": "Error",
+				"facturasend_mensaje_estado": response.get('error', 'Error desconocido')
 			}
 			
-			# Agregar observación si existe
-			if item.get("description"):
-				item_data["observacion"] = item.description
-			
-			# Agregar NCM si existe
-			if item_doc.get("facturasend_ncm"):
-				item_data["ncm"] = item_doc.get("facturasend_ncm")
-			
-			items_data.append(item_data)
-		
-		# Preparar condición de pago
-		condicion_data = prepare_payment_condition(doc)
+			if retryable:
+				queue_updates[doc.name] = get_send_retry(reintentos, settings.max_retries)
+			else:
+				queue_updates[doc.name] = {"state": QUEUE_ERROR, "attempts": reintentos}
+			queue_updates[doc.name]["last_error"] = response.get('error', 'Error desconocido')
 		
-		# Construir el documento completo
-		facturasend_doc = {
-			"tipoDocumento": tipo_documento,
-			"establecimiento": int(establecimiento),
-			"punto": str(punto).zfill(3),  # Asegurar formato "001"
-			"numero": extract_document_number(doc.name),
-			"descripcion": doc.get("facturasend_descripcion") or "",
-			"observacion": doc.get("facturasend_observacion") or "",
-			"fecha": doc.posting_date.strftime("%Y-%m-%dT%H:%M:%S") if isinstance(doc.posting_date, datetime) else f"{doc.posting_date}T00:00:00",
-			"tipoEmision": extract_number(doc.get("facturasend_tipo_emision", "1")),
-			"tipoTransaccion": extract_number(doc.get("facturasend_tipo_transaccion", "1")),
-			"tipoImpuesto": extract_number(doc.get("facturasend_tipo_impuesto", "1")),
-			"moneda": doc.currency,
-			"cliente": cliente_data,
-			"usuario": usuario_data,
-			"factura": {
-				"presencia": extract_number(doc.get("facturasend_presencia", "1"))
-			},
-			"condicion": condicion_data,
-			"items": items_data
-		}
+		bulk_update_invoice_states(updates, commit=False)
+		release_entries(queue_updates)
 		
-		return facturasend_doc
+		# Enviar notificación de error
+		send_error_notification(sent_documents, response.get('error'))
 		
-	except Exception as e:
-		frappe.log_error(frappe.get_traceback(), f"Error convirtiendo documento {doc.name}")
-		return None
+		return {"success": False, "error": response.get('error'), "errores": response.get('errores')}
 
 
-def prepare_payment_condition(doc):
-	"""Prepara la condición de pago para FacturaSend"""
-	
-	condicion = {
-		"tipo": 1,  # Contado por defecto
-		"entregas": []
-	}
+def send_to_facturasend_api(batch_data, settings):
+	"""Envía los datos a la API de FacturaSend"""
 	
-	# Determinar si es contado o crédito basado en payment_schedule
-	if doc.payment_schedule and len(doc.payment_schedule) > 0:
-		# Es a crédito
-		condicion["tipo"] = 2
-		
-		# La entrega siempre va, aunque sea a crédito
-		tipo_pago = 1  # Efectivo por defecto
-		
-		# Verificar si tiene un custom field para modo de pago
-		if hasattr(doc, 'facturasend_modo_pago') and doc.facturasend_modo_pago:
-			tipo_pago = extract_number(doc.facturasend_modo_pago)
-		
-		# Para PYG, monto como string sin decimales
-		monto_entrega = doc.grand_total
-		if doc.currency == "PYG":
-			monto_entrega = str(int(round(doc.grand_total)))
-		else:
-			monto_entrega = str(doc.grand_total)
-		
-		entrega = {
-			"tipo": tipo_pago,
-			"monto": monto_entrega,
-			"moneda": doc.currency,
-			"monedaDescripcion": get_currency_description(doc.currency),
-			"cambio": 0.0
-		}
-		condicion["entregas"].append(entrega)
-		
-		# Preparar información de crédito
-		total_cuotas = len(doc.payment_schedule)
-		cuotas_info = []
-		
-		# Calcular días totales del crédito
-		primera_fecha = doc.payment_schedule[0].due_date if doc.payment_schedule else doc.posting_date
-		ultima_fecha = doc.payment_schedule[-1].due_date if doc.payment_schedule else doc.posting_date
-		
-		# Calcular diferencia en días
-		if hasattr(primera_fecha, 'toordinal') and hasattr(ultima_fecha, 'toordinal'):
-			dias_plazo = (ultima_fecha.toordinal() - getdate(doc.posting_date).toordinal())
-		else:
-			dias_plazo = 30  # Default
-		
-		for cuota in doc.payment_schedule:
-			# Para PYG, montos sin decimales
-			monto_cuota = cuota.payment_amount
-			if doc.currency == "PYG":
-				monto_cuota = int(round(cuota.payment_amount))
-			
-			cuotas_info.append({
-				"moneda": doc.currency,
-				"monto": monto_cuota
-			})
-		
-		# montoEntrega sin decimales para PYG
-		monto_entrega_num = 0.0
-		if doc.currency == "PYG":
-			monto_entrega_num = 0
-		
-		condicion["credito"] = {
-			"tipo": 1,  # Plazo
-			"plazo": f"{dias_plazo} días",
-			"cuotas": total_cuotas,
-			"montoEntrega": monto_entrega_num,
-			"infoCuotas": cuotas_info
-		}
-	else:
-		# Es contado
-		tipo_pago = 1  # Efectivo por defecto
-		
-		# Verificar si tiene un custom field para modo de pago
-		if hasattr(doc, 'facturasend_modo_pago') and doc.facturasend_modo_pago:
-			tipo_pago = extract_number(doc.facturasend_modo_pago)
-		
-		# Para PYG, monto como string sin decimales
-		monto_entrega = doc.grand_total
-		if doc.currency == "PYG":
-			monto_entrega = str(int(round(doc.grand_total)))
-		else:
-			monto_entrega = str(doc.grand_total)
-		
-		entrega = {
-			"tipo": tipo_pago,
-			"monto": monto_entrega,
-			"moneda": doc.currency,
-			"monedaDescripcion": get_currency_description(doc.currency),
-			"cambio": 0.0
+	# Cliente HTTP compartido (conexiones keep-alive, API key ya desencriptado)
+	client = get_client()
+	if not client:
+		return {
+			"success": False,
+			"error": "API Key no configurado en FacturaSend Settings"
 		}
-		condicion["entregas"].append(entrega)
 	
-	return condicion
+	log_lote_request(client, batch_data)
+	response = post_lote(client, batch_data)
+	log_lote_response(response)
+	
+	return response
 
 
-def send_to_facturasend_api(batch_data, settings):
-	"""Envía los datos a la API de FacturaSend"""
+def log_lote_request(client, batch_data):
+	"""Registra el JSON completo del lote (solo con nivel Debug)"""
+	
+	logger = get_logger()
+	if logger.isEnabledFor(logging.DEBUG):
+		logger.debug(f"POST {client.api_root}/lote/create\n\nJSON Completo:\n{json.dumps(batch_data, indent=2, ensure_ascii=False)}")
+
+
+def post_lote(client, batch_data):
+	"""Envía un lote con `client` y retorna la respuesta interpretada
+	
+	No usa frappe (ni base de datos, ni frappe.local, ni logs), por lo que
+	puede ejecutarse en hilos del dispatcher de lotes. Los errores se
+	retornan en el resultado junto con el traceback.
+	"""
 	
 	try:
-		url = f"{settings.base_url}/{settings.tenant_id}/lote/create"
-		
-		# Obtener API key
-		api_key = settings.get_password('api_key')
-		if not api_key:
+		# Enviar como JSON en el body (equivalente a axios.post(url, data, {headers}))
+		return parse_lote_response(client.post("lote/create", batch_data))
+	except Exception as e:
+		return {
+			"success": False,
+			"error": str(e),
+			"traceback": traceback.format_exc()
+		}
+
+
+def log_lote_response(response):
+	"""Registra la respuesta de lote/create en el log de la integración"""
+	
+	if response.get('traceback'):
+		frappe.log_error(response['traceback'], "FacturaSend API Error")
+	elif response.get('success'):
+		logger = get_logger()
+		if logger.isEnabledFor(logging.DEBUG):
+			logger.debug(f"Lote aceptado:\n{json.dumps(response, ensure_ascii=False)}")
+	else:
+		get_logger().warning(f"Lote rechazado con status {response.get('status_code')}:\n{response.get('response') or response.get('error')}")
+
+
+def parse_lote_response(response):
+	"""Convierte la respuesta HTTP de lote/create al resultado del envío"""
+	
+	response_text = response.text
+	
+	if response.status_code == 200:
+		response_data = response.json()
+		# Verificar si hay errores en la respuesta exitosa
+		if not response_data.get('success') and response_data.get('errores'):
 			return {
 				"success": False,
-				"error": "API Key no configurado en FacturaSend Settings"
+				"error": format_lote_errors(response_data),
+				"errores": response_data.get('errores', []),
+				"response": response_text
 			}
 		
-		headers = {
-			"Authorization": f"Bearer {api_key}",
-			"Content-Type": "application/json"
-		}
-		
-		# Log completo para debugging
-		frappe.log_error(f"URL: {url}\n\nHeaders: {json.dumps({k: v[:20] + '...' if k == 'Authorization' else v for k, v in headers.items()}, indent=2)}\n\nJSON Completo:\n{json.dumps(batch_data, indent=2, ensure_ascii=False)}", "FacturaSend Request")
-		
-		# Enviar como JSON en el body (equivalente a axios.post(url, data, {headers}))
-		response = requests.post(
-			url, 
-			data=json.dumps(batch_data, ensure_ascii=False).encode('utf-8'),
-			headers=headers, 
-			timeout=30
-		)
-		
-		# Log de respuesta
-		response_text = response.text
-		frappe.log_error(f"Status: {response.status_code}\n\nRespuesta:\n{response_text}", "FacturaSend Response")
-		
-		if response.status_code == 200:
-			response_data = response.json()
-			# Verificar si hay errores en la respuesta exitosa
-			if not response_data.get('success') and response_data.get('errores'):
-				# Construir mensaje de error detallado
-				error_msg = response_data.get('error', 'Error desconocido')
-				errores_detalle = []
-				for err in response_data.get('errores', []):
-					index = err.get('index', 'N/A')
-					error_txt = err.get('error', 'Sin detalle')
-					errores_detalle.append(f"[Documento {index}] {error_txt}")
-				
-				error_completo = f"{error_msg}\n\nDetalles:\n" + "\n".join(errores_detalle)
-				
-				return {
-					"success": False,
-					"error": error_completo,
-					"errores": response_data.get('errores', []),
-					"response": response_text
-				}
-			
-			return response_data
-		else:
-			# Incluir response completo en el error
-			try:
-				error_data = response.json()
-				# Si el response tiene errores detallados
-				if error_data.get('errores'):
-					error_msg = error_data.get('error', f'Error HTTP {response.status_code}')
-					errores_detalle = []
-					for err in error_data.get('errores', []):
-						index = err.get('index', 'N/A')
-						error_txt = err.get('error', 'Sin detalle')
-						errores_detalle.append(f"[Documento {index}] {error_txt}")
-					
-					error_completo = f"{error_msg}\n\nDetalles:\n" + "\n".join(errores_detalle)
-					
-					return {
-						"success": False,
-						"error": error_completo,
-						"errores": error_data.get('errores', []),
-						"status_code": response.status_code,
-						"response": response_text
-					}
-			except:
-				pass
-			
+		return response_data
+	
+	# Incluir response completo en el error
+	try:
+		error_data = response.json()
+		# Si el response tiene errores detallados
+		if error_data.get('errores'):
 			return {
 				"success": False,
-				"error": f"Error HTTP {response.status_code}: {response_text}",
+				"error": format_lote_errors(error_data, f'Error HTTP {response.status_code}'),
+				"errores": error_data.get('errores', []),
 				"status_code": response.status_code,
 				"response": response_text
 			}
-			
-	except Exception as e:
-		frappe.log_error(frappe.get_traceback(), "FacturaSend API Error")
-		return {
-			"success": False,
-			"error": str(e)
-		}
+	except Exception:
+		pass
+	
+	return {
+		"success": False,
+		"error": f"Error HTTP {response.status_code}: {response_text}",
+		"status_code": response.status_code,
+		"response": response_text
+	}
+
+
+def format_lote_errors(data, default_error='Error desconocido'):
+	"""Construye el mensaje de error detallado con los errores por documento"""
+	
+	error_msg = data.get('error', default_error)
+	errores_detalle = []
+	for err in data.get('errores', []):
+		index = err.get('index', 'N/A')
+		error_txt = err.get('error', 'Sin detalle')
+		errores_detalle.append(f"[Documento {index}] {error_txt}")
+	
+	return f"{error_msg}\n\nDetalles:\n" + "\n".join(errores_detalle)
 
 
 def create_facturasend_log(response, documents, tipo_documento):
@@ -714,28 +659,86 @@ def create_facturasend_log(response, documents, tipo_documento):
 
 
 def update_documents_after_send(documents, response, log_name):
-	"""Actualiza los documentos después del envío exitoso"""
+	"""Actualiza los documentos después del envío exitoso
+	
+	Los documentos cuyo CDC ya tiene otra factura (el CDC es único) quedan en
+	error en lugar de hacer fallar el UPDATE de todo el lote. No hace commit;
+	retorna {nombre: campos escritos}.
+	"""
 	
 	de_list = response['result'].get('deList', [])
 	lote_id = response['result'].get('loteId')
+	fecha_envio = now_datetime()
+	next_check = get_next_status_check(get_facturasend_settings())
+	taken_cdcs = get_taken_cdcs(documents, de_list)
 	
+	updates = {}
 	for i, doc_info in enumerate(documents):
-		doc = frappe.get_doc("Sales Invoice", doc_info['name'])
-		
-		if i < len(de_list):
+		if i < len(de_list) and de_list[i].get('cdc') in taken_cdcs:
+			updates[doc_info['name']] = {
+				"facturasend_estado": "Error",
+				"facturasend_mensaje_estado": f"El CDC {de_list[i]['cdc']} ya está asignado a otro documento"
+			}
+		elif i < len(de_list):
 			de_info = de_list[i]
-			doc.facturasend_cdc = de_info.get('cdc', '')
-			doc.facturasend_estado = "Generado DE"  # Estado 0 - Documento generado exitosamente en FacturaSend
-			doc.facturasend_lote_id = str(lote_id)
-			doc.facturasend_fecha_envio = now_datetime()
-			doc.facturasend_mensaje_estado = f"Documento generado exitosamente. CDC: {de_info.get('cdc', '')}"
+			updates[doc_info['name']] = {
+				# NULL y no '' cuando falta: la columna tiene índice único
+				"facturasend_cdc": de_info.get('cdc') or None,
+				"facturasend_estado": "Generado DE",  # Estado 0 - Documento generado exitosamente en FacturaSend
+				"facturasend_lote_id": str(lote_id),
+				"facturasend_fecha_envio": fecha_envio,
+				"facturasend_mensaje_estado": f"Documento generado exitosamente. CDC: {de_info.get('cdc', '')}",
+				"facturasend_proxima_consulta": next_check,
+				"facturasend_consultas_sin_cambio": 0
+			}
 		else:
-			doc.facturasend_estado = "Error"
-			doc.facturasend_mensaje_estado = "No se recibió respuesta del servidor"
-		
-		doc.save(ignore_permissions=True)
+			updates[doc_info['name']] = {
+				"facturasend_estado": "Error",
+				"facturasend_mensaje_estado": "No se recibió respuesta del servidor"
+			}
 	
-	frappe.db.commit()
+	bulk_update_invoice_states(updates, commit=False)
+	
+	return updates
+
+
+def get_taken_cdcs(documents, de_list):
+	"""CDCs de la respuesta que no se pueden guardar: ya los tiene otra factura
+	o se repiten dentro del lote"""
+	
+	cdcs = [de_info.get('cdc') for de_info in de_list if de_info.get('cdc')]
+	if not cdcs:
+		return set()
+	
+	taken = set(frappe.get_all("Sales Invoice",
+		filters={
+			"facturasend_cdc": ["in", cdcs],
+			"name": ["not in", [doc_info['name'] for doc_info in documents]]
+		},
+		pluck="facturasend_cdc"
+	))
+	
+	seen = set()
+	for cdc in cdcs:
+		if cdc in seen:
+			taken.add(cdc)
+		seen.add(cdc)
+	
+	return taken
+
+
+def bulk_update_invoice_states(updates, commit=True):
+	"""Escribe campos facturasend_* de muchas facturas en un solo UPDATE por bloque
+	
+	`updates` es {nombre_factura: {campo: valor}}. Solo se modifican las columnas
+	indicadas: no se ejecutan validaciones de Sales Invoice, no se crean
+	versiones y no se toca `modified`. Hace un solo commit al final.
+	"""
+	
+	bulk_update_records("Sales Invoice", updates)
+	
+	if commit:
+		frappe.db.commit()
 
 
 @frappe.whitelist()
@@ -746,61 +749,10 @@ def download_kude_by_cdc(cdcs):
 		cdcs = json.loads(cdcs)
 	
 	try:
-		settings = get_facturasend_settings()
-		
 		if not cdcs or len(cdcs) == 0:
 			return {"success": False, "error": "No se proporcionaron CDCs"}
 		
-		# Llamar a la API para obtener PDFs
-		url = f"{settings.base_url}/{settings.tenant_id}/de/pdf"
-		
-		api_key = settings.get_password('api_key')
-		if not api_key:
-			return {"success": False, "error": "API Key no configurado"}
-		
-		headers = {
-			"Authorization": f"Bearer {api_key}",
-			"Content-Type": "application/json"
-		}
-		
-		# Convertir CDCs a formato correcto: lista de objetos con propiedad "cdc"
-		cdc_list = [{"cdc": cdc} for cdc in cdcs]
-		
-		payload = {
-			"cdcList": cdc_list,
-			"format": "a4"
-		}
-		
-		frappe.log_error(f"POST {url}\nPayload: {json.dumps(payload, indent=2)}", "FacturaSend KUDE by CDC Request")
-		
-		response = requests.post(url, json=payload, headers=headers, timeout=30)
-		
-		frappe.log_error(f"Status: {response.status_code}\nContent-Type: {response.headers.get('Content-Type', 'N/A')}\nContent-Length: {len(response.content)}", "FacturaSend KUDE by CDC Response")
-		
-		if response.status_code == 200:
-			# La respuesta viene directamente como PDF binario
-			content_type = response.headers.get('Content-Type', '')
-			if 'application/pdf' in content_type or len(response.content) > 0:
-				import base64
-				pdf_base64 = base64.b64encode(response.content).decode()
-				
-				return {
-					"success": True,
-					"pdf_content": pdf_base64,
-					"pdf_url": f"data:application/pdf;base64,{pdf_base64}"
-				}
-			else:
-				# Si no es PDF, intentar parsear como JSON para ver si hay error
-				try:
-					response_data = response.json()
-					error_msg = response_data.get('error', 'Error desconocido')
-					frappe.log_error(f"Response error: {response.text[:500]}", "FacturaSend KUDE by CDC Error")
-					return {"success": False, "error": error_msg}
-				except:
-					frappe.log_error(f"Response no es PDF: {response.text[:500]}", "FacturaSend KUDE by CDC Error")
-					return {"success": False, "error": f"La respuesta no es un PDF válido: {response.text[:200]}"}
-		else:
-			return {"success": False, "error": f"Error al descargar KUDEs: {response.text}"}
+		return get_kude_file(cdcs)
 			
 	except Exception as e:
 		frappe.log_error(frappe.get_traceback(), "Error descargando KUDEs por CDC")
@@ -809,82 +761,55 @@ def download_kude_by_cdc(cdcs):
 
 @frappe.whitelist()
 def download_batch_kude(documents):
-	"""Descarga los KUDEs de un lote de documentos"""
+	"""Descarga los KUDEs de un lote de documentos
+	
+	El KUDE de un solo documento queda adjunto a la factura.
+	"""
 	
 	if isinstance(documents, str):
 		documents = json.loads(documents)
 	
 	try:
-		settings = get_facturasend_settings()
-		
-		# Obtener CDCs de los documentos
-		cdcs = []
-		for doc_info in documents:
-			doc = frappe.get_doc("Sales Invoice", doc_info['name'])
-			if doc.facturasend_cdc:
-				cdcs.append(doc.facturasend_cdc)
+		# Obtener CDCs de los documentos, en el orden de la selección
+		names = [doc_info['name'] for doc_info in documents]
+		cdcs = list(get_document_cdcs(names).values())
 		
 		if not cdcs:
 			return {"success": False, "error": "Los documentos seleccionados no tienen CDC"}
 		
-		# Llamar a la API para obtener PDFs - POST /de/pdf según documentación
-		url = f"{settings.base_url}/{settings.tenant_id}/de/pdf"
-		
-		api_key = settings.get_password('api_key')
-		if not api_key:
-			return {"success": False, "error": "API Key no configurado"}
-		
-		headers = {
-			"Authorization": f"Bearer {api_key}",
-			"Content-Type": "application/json"
-		}
-		
-		# Convertir CDCs a formato correcto: lista de objetos con propiedad "cdc"
-		cdc_list = [{"cdc": cdc} for cdc in cdcs]
-		
-		payload = {
-			"cdcList": cdc_list,
-			"format": "a4"
-		}
-		
-		frappe.log_error(f"POST {url}\nPayload: {json.dumps(payload, indent=2)}", "FacturaSend KUDE Request")
-		
-		response = requests.post(url, json=payload, headers=headers, timeout=30)
-		
-		frappe.log_error(f"Status: {response.status_code}\nContent-Type: {response.headers.get('Content-Type', 'N/A')}\nContent-Length: {len(response.content)}", "FacturaSend KUDE Response")
-		
-		if response.status_code == 200:
-			# La respuesta viene directamente como PDF binario
-			content_type = response.headers.get('Content-Type', '')
-			if 'application/pdf' in content_type or len(response.content) > 0:
-				import base64
-				pdf_base64 = base64.b64encode(response.content).decode()
-				
-				return {
-					"success": True,
-					"pdf_content": pdf_base64,
-					"pdf_url": f"data:application/pdf;base64,{pdf_base64}"
-				}
-			else:
-				# Si no es PDF, intentar parsear como JSON para ver si hay error
-				try:
-					response_data = response.json()
-					error_msg = response_data.get('error', 'Error desconocido')
-					frappe.log_error(f"Response error: {response.text[:500]}", "FacturaSend KUDE Error")
-					return {"success": False, "error": error_msg}
-				except:
-					frappe.log_error(f"Response no es PDF: {response.text[:500]}", "FacturaSend KUDE Error")
-					return {"success": False, "error": f"La respuesta no es un PDF válido: {response.text[:200]}"}
-		else:
-			return {"success": False, "error": f"Error al descargar KUDEs: {response.text}"}
+		return get_kude_file(cdcs, attach_to=names[0] if len(names) == 1 else None)
 			
 	except Exception as e:
 		frappe.log_error(frappe.get_traceback(), "Error descargando KUDEs")
 		return {"success": False, "error": str(e)}
 
 
+# CDCs por llamada a /de/estado
+STATUS_QUERY_CHUNK_SIZE = 50
+
+# Documentos leídos por página al recorrer la cola de estados
+STATUS_PAGE_SIZE = 200
+
+# Estados no terminales que se siguen consultando en FacturaSend
+STATUS_PENDING_STATES = ["Generado DE", "Enviado en Lote"]
+
+# Estados aprobados: al llegar a uno se precarga el KUDE
+APPROVED_STATES = ["Aprobado", "Aprobado con observación"]
+
+# Espera máxima entre consultas de un documento cuyo estado no cambia
+STATUS_MAX_BACKOFF_MINUTES = 24 * 60
+
+
 def check_document_status():
-	"""Scheduled job para consultar estados de documentos enviados"""
+	"""Scheduled job para consultar estados de documentos enviados
+	
+	Toma de la cola las entradas en consulta cuyo próximo intento ya venció,
+	de a una página reservada por vez, hasta agotar el tiempo disponible
+	(`status_check_time_budget`). Cada entrada consultada se reprograma
+	(ver `get_next_status_check`) o sale de la consulta si llegó a un estado
+	final, así toda la cola se consulta de forma pareja aunque haya varios
+	workers.
+	"""
 	
 	try:
 		# Obtener configuración
@@ -893,142 +818,232 @@ def check_document_status():
 			frappe.log_error("No se encontró FacturaSend Settings", "FacturaSend Status Check")
 			return
 		
-		# Buscar documentos con estado "Generado DE" (Estado 0) que necesitan actualización
-		pending_docs = frappe.get_all("Sales Invoice",
-			filters={
-				"docstatus": 1,
-				"facturasend_estado": ["in", ["Generado DE"]],
-				"facturasend_cdc": ["!=", ""]
-			},
-			fields=["name", "facturasend_cdc"],
-			limit=100
-		)
-		
-		frappe.log_error(f"Encontrados {len(pending_docs)} documentos pendientes de actualización", "FacturaSend Status Check")
+		deadline = time.monotonic() + (cint(settings.status_check_time_budget) or 50)
+		checked = updated = 0
 		
-		if not pending_docs:
-			return
-		
-		# Consultar estado de cada documento individualmente por CDC
-		for doc_info in pending_docs:
-			try:
-				frappe.log_error(f"Consultando estado de {doc_info.name} con CDC {doc_info.facturasend_cdc}", "FacturaSend Status Check Doc")
-				status_data = get_document_status_by_cdc(doc_info.facturasend_cdc, settings)
-				
-				if status_data and status_data.get('success'):
-					frappe.log_error(f"Documento {doc_info.name} consultado exitosamente", "FacturaSend Status Check OK")
-					update_single_document_status(doc_info.name, status_data)
-				else:
-					frappe.log_error(f"Error consultando {doc_info.name}: {status_data.get('error', 'Unknown')}", "FacturaSend Status Check Error")
-			except Exception as e:
-				frappe.log_error(frappe.get_traceback(), f"Error consultando estado del documento {doc_info.name}")
+		while time.monotonic() < deadline:
+			entries = claim_entries(QUEUE_POLLING, limit=STATUS_PAGE_SIZE)
+			if not entries:
+				break
+			
+			names = [entry.name for entry in entries]
+			pending_docs = get_status_check_docs(names)
+			
+			# Facturas borradas: sacarlas de la cola
+			found = {doc_info.name for doc_info in pending_docs}
+			release_entries({name: {"state": QUEUE_DONE} for name in names if name not in found}, commit=False)
+			
+			updated += check_documents_status(pending_docs, settings)
+			checked += len(entries)
+			frappe.db.commit()
 		
-		frappe.log_error(f"Consulta de estados completada para {len(pending_docs)} documentos", "FacturaSend Status Check Complete")
+		get_logger().info(f"Consulta de estados completada: {updated} de {checked} documentos actualizados")
 		
 	except Exception as e:
 		frappe.log_error(frappe.get_traceback(), "FacturaSend Status Check Fatal Error")
 
 
-def get_document_status_by_cdc(cdc, settings):
-	"""Consulta el estado de un documento electrónico por CDC"""
+def get_status_check_docs(names):
+	"""Facturas de las entradas de la cola reservadas para consultar su estado"""
 	
-	try:
-		url = f"{settings.base_url}/{settings.tenant_id}/de/estado"
-		
-		api_key = settings.get_password('api_key')
-		if not api_key:
-			return {"success": False, "error": "API Key no configurado"}
+	return frappe.get_all("Sales Invoice",
+		filters={"name": ["in", names]},
+		fields=["name", "docstatus", "facturasend_cdc", "facturasend_estado", "facturasend_consultas_sin_cambio"]
+	)
+
+
+def check_documents_status(pending_docs, settings):
+	"""Consulta y actualiza el estado de una página de documentos
+	
+	Actualiza las facturas y libera sus entradas de la cola sin hacer commit.
+	Retorna la cantidad de documentos actualizados.
+	"""
+	
+	queue_updates = {}
+	docs_by_cdc = {}
+	for doc_info in pending_docs:
+		if doc_info.docstatus == 1 and doc_info.facturasend_cdc and doc_info.facturasend_estado in STATUS_PENDING_STATES:
+			docs_by_cdc[doc_info.facturasend_cdc] = doc_info
+		else:
+			# Cancelado o cambiado a mano: ya no hay nada que consultar
+			queue_updates[doc_info.name] = {"state": QUEUE_DONE}
+	
+	# Consultar los estados en bloques de CDCs, una llamada a /de/estado por bloque
+	statuses = {}
+	
+	cdcs = list(docs_by_cdc)
+	for i in range(0, len(cdcs), STATUS_QUERY_CHUNK_SIZE):
+		chunk = cdcs[i:i + STATUS_QUERY_CHUNK_SIZE]
+		response = get_documents_status_by_cdcs(chunk, settings)
 		
-		headers = {
-			"Authorization": f"Bearer {api_key}",
-			"Content-Type": "application/json"
+		if response.get('success'):
+			statuses.update(response['statuses'])
+		else:
+			get_logger().error(f"Error consultando {len(chunk)} CDCs: {response.get('error', 'Unknown')}")
+	
+	# Actualizar todos los documentos consultados en una sola escritura
+	updates = {
+		docs_by_cdc[cdc].name: get_status_update(docs_by_cdc[cdc], status_data, settings)
+		for cdc, status_data in statuses.items()
+		if cdc in docs_by_cdc
+	}
+	bulk_update_invoice_states(updates, commit=False)
+	
+	# Precargar los KUDEs de los documentos que se acaban de aprobar
+	enqueue_kude_prefetch([
+		cdc for cdc, doc_info in docs_by_cdc.items()
+		if doc_info.name in updates and is_approval(doc_info, updates[doc_info.name])
+	])
+	
+	for doc_info in docs_by_cdc.values():
+		queue_updates[doc_info.name] = get_status_queue_update(doc_info, updates.get(doc_info.name), settings)
+	release_entries(queue_updates, commit=False)
+	
+	return len(updates)
+
+
+def is_approval(doc_info, values):
+	"""Si la actualización de estado pasa el documento a aprobado"""
+	
+	return values['facturasend_estado'] in APPROVED_STATES and doc_info.facturasend_estado not in APPROVED_STATES
+
+
+def get_status_queue_update(doc_info, values, settings):
+	"""Estado de la entrada de la cola después de consultar un documento
+	
+	`values` son los campos escritos en la factura, o None si FacturaSend no
+	retornó su estado (se vuelve a consultar más tarde).
+	"""
+	
+	if not values:
+		return {
+			"state": QUEUE_POLLING,
+			"next_attempt": get_next_status_check(settings, doc_info.facturasend_consultas_sin_cambio)
 		}
+	
+	if values['facturasend_estado'] in STATUS_PENDING_STATES:
+		return {"state": QUEUE_POLLING, "next_attempt": values['facturasend_proxima_consulta']}
+	
+	if values['facturasend_estado'] in ("Rechazado", "Error"):
+		return {"state": QUEUE_ERROR, "last_error": values['facturasend_mensaje_estado']}
+	
+	return {"state": QUEUE_DONE}
+
+
+def get_next_status_check(settings, unchanged_checks=0):
+	"""Fecha de la próxima consulta de estado de un documento
+	
+	Parte de `status_check_interval` y se duplica por cada consulta en la que el
+	estado no cambió, hasta un máximo de `STATUS_MAX_BACKOFF_MINUTES`.
+	"""
+	
+	interval = cint(settings.status_check_interval) or 5
+	minutes = min(interval * (2 ** min(cint(unchanged_checks), 16)), STATUS_MAX_BACKOFF_MINUTES)
+	
+	return add_to_date(now_datetime(), minutes=minutes)
+
+
+def get_documents_status_by_cdcs(cdcs, settings):
+	"""Consulta el estado de varios documentos electrónicos en una sola llamada
+	
+	Retorna {"success": True, "statuses": {cdc: estado}} donde cada estado tiene
+	`estado`, `estadoDescripcion` y `message` (ver `get_status_update`).
+	"""
+	
+	try:
+		client = get_client()
+		if not client:
+			return {"success": False, "error": "API Key no configurado"}
 		
-		# El endpoint requiere cdcList como array, no cdc individual
 		payload = {
-			"cdcList": [cdc]
+			"cdcList": list(cdcs)
 		}
 		
-		frappe.log_error(f"POST {url}\nPayload: {json.dumps(payload, indent=2)}", "FacturaSend Status Query Request")
+		logger = get_logger()
+		logger.debug(f"POST {client.api_root}/de/estado con {len(payload['cdcList'])} CDCs")
 		
-		response = requests.post(url, json=payload, headers=headers, timeout=30)
+		response = client.post("de/estado", payload)
 		
-		frappe.log_error(f"Status: {response.status_code}\nResponse: {response.text}", "FacturaSend Status Query Response")
+		logger.debug(f"Status: {response.status_code}\nResponse: {response.text}")
 		
-		if response.status_code == 200:
-			response_data = response.json()
-			# La respuesta contiene un array de estados, extraer el primero
-			if response_data.get('success') and response_data.get('result'):
-				# Retornar el primer resultado con la estructura esperada
-				result = response_data.get('result', [{}])[0] if isinstance(response_data.get('result'), list) else response_data.get('result', {})
-				return {
-					"success": True,
-					"estado": result.get('estado'),
-					"estadoDescripcion": result.get('estadoDescripcion'),
-					"message": response_data.get('message', '')
-				}
-			return response_data
-		else:
+		if response.status_code != 200:
 			return {"success": False, "error": f"Error HTTP {response.status_code}: {response.text}"}
+		
+		response_data = response.json()
+		if not response_data.get('success'):
+			return {"success": False, "error": response_data.get('error', 'Error desconocido')}
+		
+		results = response_data.get('result') or []
+		if not isinstance(results, list):
+			results = [results]
+		
+		statuses = {}
+		for i, result in enumerate(results):
+			# Asociar por CDC; si la respuesta no lo incluye, por posición
+			cdc = result.get('cdc') or (cdcs[i] if i < len(cdcs) else None)
+			if not cdc:
+				continue
 			
+			statuses[cdc] = {
+				"success": True,
+				"estado": result.get('estado'),
+				"estadoDescripcion": result.get('estadoDescripcion'),
+				"message": response_data.get('message', '')
+			}
+		
+		return {"success": True, "statuses": statuses}
+		
 	except Exception as e:
 		frappe.log_error(frappe.get_traceback(), "FacturaSend Status Query Error")
 		return {"success": False, "error": str(e)}
 
 
-def update_single_document_status(doc_name, status_data):
-	"""Actualiza el estado de un documento según la respuesta de FacturaSend"""
+# Estados de FacturaSend:
+# 0 = Generado DE (documento creado exitosamente)
+# 1 = Enviado en Lote (enviado para aprobación)
+# 2 = Aprobado (aprobado por SET)
+# 3 = Aprobado con observación
+# 4 = Rechazado
+# 88 = Inexistente
+# 99 = Cancelado
+FACTURASEND_ESTADOS = {
+	'0': 'Generado DE',
+	'1': 'Enviado en Lote',
+	'2': 'Aprobado',
+	'3': 'Aprobado con observación',
+	'4': 'Rechazado',
+	'88': 'Error',  # Inexistente
+	'99': 'Cancelado'
+}
+
+
+def get_status_update(doc_info, status_data, settings):
+	"""Campos facturasend_* a escribir según la respuesta de estado de FacturaSend"""
 	
-	try:
-		# La respuesta tiene la estructura:
-		# {"success": true, "message": "Consulta exitosa", "estado": "2", ...}
-		# Estados de FacturaSend:
-		# 0 = Generado DE (documento creado exitosamente)
-		# 1 = Enviado en Lote (enviado para aprobación)
-		# 2 = Aprobado (aprobado por SET)
-		# 3 = Aprobado con observación
-		# 4 = Rechazado
-		# 88 = Inexistente
-		# 99 = Cancelado
-		
-		doc = frappe.get_doc("Sales Invoice", doc_name)
-		
-		# Mapear estado de FacturaSend a nuestros estados
-		estado_fs = str(status_data.get('estado', '0'))
-		
-		if estado_fs == '2':
-			doc.facturasend_estado = 'Aprobado'
-		elif estado_fs == '3':
-			doc.facturasend_estado = 'Aprobado con observación'
-		elif estado_fs == '4':
-			doc.facturasend_estado = 'Rechazado'
-		elif estado_fs == '1':
-			doc.facturasend_estado = 'Enviado en Lote'
-		elif estado_fs == '0':
-			doc.facturasend_estado = 'Generado DE'  # Mantener como Generado DE
-		elif estado_fs == '99':
-			doc.facturasend_estado = 'Cancelado'
-		elif estado_fs == '88':
-			doc.facturasend_estado = 'Error'  # Inexistente
-		else:
-			doc.facturasend_estado = 'Generado DE'  # Default
-		
-		# Actualizar mensaje con la información del estado
-		mensaje_partes = []
-		if status_data.get('message'):
-			mensaje_partes.append(status_data.get('message'))
-		if status_data.get('estadoDescripcion'):
-			mensaje_partes.append(status_data.get('estadoDescripcion'))
-		
-		doc.facturasend_mensaje_estado = ' - '.join(mensaje_partes) if mensaje_partes else f"Estado {estado_fs}"
-		doc.save(ignore_permissions=True)
-		
-		frappe.db.commit()
-		
-		frappe.log_error(f"Documento {doc_name} actualizado a estado {doc.facturasend_estado}", "FacturaSend Update Status")
-		
-	except Exception as e:
-		frappe.log_error(frappe.get_traceback(), f"Error actualizando estado de {doc_name}")
+	# La respuesta tiene la estructura:
+	# {"success": true, "message": "Consulta exitosa", "estado": "2", ...}
+	estado_fs = str(status_data.get('estado', '0'))
+	estado = FACTURASEND_ESTADOS.get(estado_fs, 'Generado DE')  # Default: Generado DE
+	
+	# Actualizar mensaje con la información del estado
+	mensaje_partes = []
+	if status_data.get('message'):
+		mensaje_partes.append(status_data.get('message'))
+	if status_data.get('estadoDescripcion'):
+		mensaje_partes.append(status_data.get('estadoDescripcion'))
+	
+	# Espaciar las consultas mientras el estado no cambie
+	if estado == doc_info.facturasend_estado:
+		consultas_sin_cambio = cint(doc_info.facturasend_consultas_sin_cambio) + 1
+	else:
+		consultas_sin_cambio = 0
+	
+	return {
+		"facturasend_estado": estado,
+		"facturasend_mensaje_estado": ' - '.join(mensaje_partes) if mensaje_partes else f"Estado {estado_fs}",
+		"facturasend_consultas_sin_cambio": consultas_sin_cambio,
+		"facturasend_proxima_consulta": get_next_status_check(settings, consultas_sin_cambio)
+	}
 
 
 def send_error_notification(documents, error_message):
@@ -1057,140 +1072,3 @@ def send_error_notification(documents, error_message):
 		subject=_("Error en envío a FacturaSend"),
 		message=message
 	)
-
-
-# Funciones auxiliares
-
-def get_facturasend_settings():
-	"""Obtiene la configuración de FacturaSend"""
-	if not frappe.db.exists("FacturaSend Settings", "FacturaSend Settings"):
-		frappe.throw(_("Por favor configure FacturaSend Settings primero"))
-	
-	return frappe.get_doc("FacturaSend Settings", "FacturaSend Settings")
-
-
-def extract_establecimiento_punto(doc_name, settings):
-	"""Extrae establecimiento y punto de expedición de la serie del documento"""
-	
-	# Formato esperado: FC-001-001-.#######
-	parts = doc_name.split('-')
-	
-	if len(parts) >= 3:
-		establecimiento = parts[1]
-		punto = str(parts[2]).zfill(3)  # Asegurar formato "001"
-	else:
-		# Usar valores por defecto de la configuración
-		establecimiento = settings.establecimiento
-		punto = str(settings.punto_expedicion).zfill(3)
-	
-	return establecimiento, punto
-
-
-def extract_document_number(doc_name):
-	"""Extrae el número del documento de la serie"""
-	
-	# Formato esperado: FC-001-001-.#######
-	parts = doc_name.split('-')
-	
-	if len(parts) >= 4:
-		# El último elemento debería ser el número
-		try:
-			return int(parts[-1])
-		except:
-			return 1
-	
-	return 1
-
-
-def extract_number(value):
-	"""Extrae el número de un string tipo '1 - Descripción'"""
-	if isinstance(value, int):
-		return value
-	
-	if isinstance(value, str):
-		parts = value.split('-')
-		try:
-			return int(parts[0].strip())
-		except:
-			return 1
-	
-	return 1
-
-
-def map_payment_mode_to_fs(mode_of_payment):
-	"""Mapea modo de pago de ERPNext a tipo de FacturaSend"""
-	
-	mode_map = {
-		"Cash": 1,
-		"Efectivo": 1,
-		"Credit Card": 3,
-		"Tarjeta": 3,
-		"Cheque": 2,
-		"Bank Transfer": 4,
-		"Transferencia": 4
-	}
-	
-	return mode_map.get(mode_of_payment, 1)
-
-
-def get_currency_description(currency):
-	"""Obtiene la descripción de la moneda"""
-	
-	currency_map = {
-		"PYG": "Guaraní",
-		"USD": "Dólar",
-		"EUR": "Euro",
-		"BRL": "Real"
-	}
-	
-	return currency_map.get(currency, currency)
-
-
-def get_customer_primary_contact(customer_name):
-	"""Obtiene el contacto principal del cliente"""
-	
-	try:
-		# Buscar el vínculo entre Customer y Contact
-		links = frappe.get_all("Dynamic Link",
-			filters={
-				"link_doctype": "Customer",
-				"link_name": customer_name,
-				"parenttype": "Contact"
-			},
-			fields=["parent"],
-			limit=1
-		)
-		
-		if links:
-			contact = frappe.get_doc("Contact", links[0].parent)
-			return contact
-		
-		return None
-	except Exception as e:
-		frappe.log_error(f"Error obteniendo contacto de {customer_name}: {str(e)}", "Get Customer Contact")
-		return None
-
-
-def get_customer_primary_address(customer_name):
-	"""Obtiene la dirección principal del cliente"""
-	
-	try:
-		# Buscar el vínculo entre Customer y Address
-		links = frappe.get_all("Dynamic Link",
-			filters={
-				"link_doctype": "Customer",
-				"link_name": customer_name,
-				"parenttype": "Address"
-			},
-			fields=["parent"],
-			limit=1
-		)
-		
-		if links:
-			address = frappe.get_doc("Address", links[0].parent)
-			return address
-		
-		return None
-	except Exception as e:
-		frappe.log_error(f"Error obteniendo dirección de {customer_name}: {str(e)}", "Get Customer Address")
-		return None
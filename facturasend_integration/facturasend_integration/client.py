@@ -0,0 +1,272 @@
+# Copyright (c) 2025, Luis and contributors
+# For license information, please see license.txt
+
+import gzip
+import json
+import threading
+import time
+from email.utils import parsedate_to_datetime
+
+import frappe
+import requests
+from requests.adapters import HTTPAdapter
+from facturasend_integration.facturasend_integration.settings import get_facturasend_credentials
+
+
+# Conexiones keep-alive que se mantienen abiertas por worker
+POOL_SIZE = 10
+
+# Los cuerpos más chicos que esto no se comprimen
+COMPRESS_MIN_BYTES = 1024
+
+# Reintentos ante 429 (Too Many Requests) antes de devolver la respuesta
+MAX_THROTTLE_RETRIES = 5
+
+# Espera en segundos ante un 429 sin Retry-After (se duplica en cada reintento)
+THROTTLE_BACKOFF = 1
+
+# Espera máxima en segundos que se acepta de un Retry-After
+MAX_RETRY_AFTER = 60
+
+# Hash de Redis con los contadores de latencia por endpoint, de todos los workers
+STATS_KEY = "facturasend_api_stats"
+
+# Suma un request a los contadores de un endpoint en una sola operación atómica
+RECORD_LATENCY_SCRIPT = """
+redis.call('HINCRBY', KEYS[1], ARGV[1] .. ':count', 1)
+redis.call('HINCRBY', KEYS[1], ARGV[1] .. ':errors', ARGV[3])
+redis.call('HINCRBYFLOAT', KEYS[1], ARGV[1] .. ':total_ms', ARGV[2])
+local max_ms = tonumber(redis.call('HGET', KEYS[1], ARGV[1] .. ':max_ms') or '0')
+if tonumber(ARGV[2]) > max_ms then
+	redis.call('HSET', KEYS[1], ARGV[1] .. ':max_ms', ARGV[2])
+end
+"""
+
+# Clave de Redis con el estado del limitador de requests por segundo
+RATE_LIMIT_KEY = "facturasend_rate_limit"
+
+# Toma un token del limitador; retorna 0 o los segundos a esperar por el próximo
+TOKEN_BUCKET_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(state[1]) or capacity
+local updated = tonumber(state[2]) or now
+tokens = math.min(capacity, tokens + math.max(now - updated, 0) * rate)
+local wait = 0
+if tokens >= 1 then
+	tokens = tokens - 1
+else
+	wait = (1 - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 1)
+return tostring(wait)
+"""
+
+# Cliente por sitio, reutilizado entre requests del mismo worker
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+class TokenBucket:
+	"""Limitador de requests por segundo (token bucket) compartido en Redis
+
+	El estado vive en Redis, así el límite es global para todos los workers
+	y sus hilos. Se recargan `rate` tokens por segundo hasta un máximo de
+	`burst`. Cada request consume un token y espera si no hay disponibles.
+	"""
+
+	def __init__(self, redis, key, rate, burst=None):
+		self.key = key
+		self.rate = float(rate)
+		self.capacity = float(max(burst or 1, 1))
+		self.script = redis.register_script(TOKEN_BUCKET_SCRIPT)
+
+	def acquire(self):
+		"""Consume un token, esperando lo necesario"""
+
+		while True:
+			wait = float(self.script(keys=[self.key], args=[self.rate, self.capacity]))
+			if wait <= 0:
+				return
+
+			time.sleep(wait)
+
+
+class FacturaSendClient:
+	"""Cliente HTTP de la API de FacturaSend
+
+	Mantiene una requests.Session con pool de conexiones keep-alive, timeouts
+	separados de conexión y lectura, compresión opcional del cuerpo y
+	contadores de latencia por endpoint, acumulados en Redis para todos los
+	workers. La conexión a Redis y las claves se resuelven al crear el
+	cliente, así los hilos no usan frappe.local. Opcionalmente limita los requests
+	por segundo y, ante un 429, pausa todos los hilos el tiempo indicado en
+	Retry-After antes de reintentar.
+	"""
+
+	def __init__(self, api_root, headers, connect_timeout=5, read_timeout=30, compress=False,
+			rate_limit=0, rate_burst=0, pool_size=POOL_SIZE):
+		self.api_root = api_root
+		self.timeout = (connect_timeout, read_timeout)
+		self.compress = compress
+		redis = frappe.cache()
+		self.stats_key = redis.make_key(STATS_KEY)
+		self.record_latency_script = redis.register_script(RECORD_LATENCY_SCRIPT)
+		self.rate_limiter = TokenBucket(redis, redis.make_key(RATE_LIMIT_KEY), rate_limit, rate_burst or rate_limit) if rate_limit > 0 else None
+		self.paused_until = 0
+		self.pause_lock = threading.Lock()
+
+		self.session = requests.Session()
+		self.session.headers.update(headers)
+		adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+		self.session.mount("https://", adapter)
+		self.session.mount("http://", adapter)
+
+	def post(self, endpoint, payload, stream=False, timeout=None):
+		"""POST de `payload` como JSON a `endpoint` (ej: "lote/create")"""
+
+		body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+		headers = {}
+
+		if self.compress and len(body) >= COMPRESS_MIN_BYTES:
+			body = gzip.compress(body)
+			headers["Content-Encoding"] = "gzip"
+
+		for attempt in range(MAX_THROTTLE_RETRIES + 1):
+			self.wait_for_turn()
+
+			start = time.monotonic()
+			failed = True
+			try:
+				response = self.session.post(
+					f"{self.api_root}/{endpoint}",
+					data=body,
+					headers=headers,
+					timeout=timeout or self.timeout,
+					stream=stream
+				)
+				failed = response.status_code >= 400
+			finally:
+				self.record_latency(endpoint, time.monotonic() - start, failed)
+
+			if response.status_code != 429 or attempt == MAX_THROTTLE_RETRIES:
+				return response
+
+			delay = get_retry_after(response) or THROTTLE_BACKOFF * 2 ** attempt
+			response.close()
+			self.pause(delay)
+
+	def wait_for_turn(self):
+		"""Espera una pausa por 429 en curso y un token del limitador"""
+
+		with self.pause_lock:
+			wait = self.paused_until - time.monotonic()
+
+		if wait > 0:
+			time.sleep(wait)
+
+		if self.rate_limiter:
+			self.rate_limiter.acquire()
+
+	def pause(self, delay):
+		"""Pausa los requests de todos los hilos durante `delay` segundos"""
+
+		with self.pause_lock:
+			self.paused_until = max(self.paused_until, time.monotonic() + min(delay, MAX_RETRY_AFTER))
+
+	def record_latency(self, endpoint, elapsed, failed):
+		"""Acumula cantidad, errores y latencia de un endpoint"""
+
+		try:
+			self.record_latency_script(keys=[self.stats_key], args=[endpoint, elapsed * 1000, 1 if failed else 0])
+		except Exception:
+			# Los contadores no deben cortar un envío
+			pass
+
+
+def get_stats():
+	"""Contadores de latencia por endpoint de todos los workers, con promedio en ms"""
+
+	# HGETALL directo: los valores los escribe el script de Redis, sin pickle
+	redis = frappe.cache()
+	raw = redis.execute_command("HGETALL", redis.make_key(STATS_KEY))
+
+	stats = {}
+	for field, value in raw.items():
+		endpoint, counter = frappe.safe_decode(field).rsplit(":", 1)
+		stats.setdefault(endpoint, {"count": 0, "errors": 0, "total_ms": 0.0, "max_ms": 0.0})[counter] = float(value)
+
+	for endpoint_stats in stats.values():
+		endpoint_stats["count"] = int(endpoint_stats["count"])
+		endpoint_stats["errors"] = int(endpoint_stats["errors"])
+		endpoint_stats["avg_ms"] = endpoint_stats["total_ms"] / endpoint_stats["count"] if endpoint_stats["count"] else 0
+
+	return stats
+
+
+def get_retry_after(response):
+	"""Segundos de espera del header Retry-After (segundos o fecha HTTP)"""
+
+	value = response.headers.get("Retry-After")
+	if not value:
+		return None
+
+	try:
+		return max(float(value), 0)
+	except ValueError:
+		pass
+
+	try:
+		return max(parsedate_to_datetime(value).timestamp() - time.time(), 0)
+	except (AttributeError, TypeError, ValueError):
+		return None
+
+
+def get_client():
+	"""Obtiene el cliente HTTP compartido del worker
+
+	Retorna None si no hay API Key configurado. El cliente se vuelve a crear
+	solo si cambian las credenciales o los parámetros de conexión; quien ya
+	tiene el anterior lo sigue usando hasta terminar.
+	"""
+
+	credentials = get_facturasend_credentials()
+	if not credentials.api_key:
+		return None
+
+	key = (
+		credentials.api_root,
+		credentials.api_key,
+		credentials.connect_timeout,
+		credentials.read_timeout,
+		credentials.compress_requests,
+		credentials.rate_limit,
+		credentials.rate_burst,
+		credentials.max_concurrent_lotes
+	)
+
+	site = frappe.local.site
+	with _clients_lock:
+		cached = _clients.get(site)
+		if cached and cached[0] == key:
+			return cached[1]
+
+		client = FacturaSendClient(
+			credentials.api_root,
+			credentials.headers,
+			connect_timeout=credentials.connect_timeout,
+			read_timeout=credentials.read_timeout,
+			compress=credentials.compress_requests,
+			rate_limit=credentials.rate_limit,
+			rate_burst=credentials.rate_burst,
+			pool_size=max(POOL_SIZE, credentials.max_concurrent_lotes)
+		)
+		# El cliente anterior no se cierra: hilos de un envío en curso pueden
+		# estar usándolo; sus conexiones se liberan cuando ya nadie lo usa
+		_clients[site] = (key, client)
+
+	return client
@@ -0,0 +1,557 @@
+# Copyright (c) 2025, Luis and contributors
+# For license information, please see license.txt
+
+import hashlib
+from collections import OrderedDict
+from datetime import datetime
+
+import frappe
+from frappe import _
+from frappe.utils import getdate
+from facturasend_integration.facturasend_integration.prefetch import prefetch_conversion_data
+from facturasend_integration.facturasend_integration.taxes import get_item_iva
+
+
+# Mapeo declarativo de cada sección del JSON de FacturaSend:
+# (clave en FacturaSend, DocType de origen, campo o tupla de campos alternativos, valor por defecto)
+# Los campos Select de los fixtures se convierten a su código ("1 - Normal" -> 1)
+
+DOCUMENTO_FIELDS = [
+	("descripcion", "Sales Invoice", "facturasend_descripcion", ""),
+	("observacion", "Sales Invoice", "facturasend_observacion", ""),
+	("tipoEmision", "Sales Invoice", "facturasend_tipo_emision", 1),
+	("tipoTransaccion", "Sales Invoice", "facturasend_tipo_transaccion", 1),
+	("tipoImpuesto", "Sales Invoice", "facturasend_tipo_impuesto", 1),
+	("moneda", "Sales Invoice", "currency", None)
+]
+
+FACTURA_FIELDS = [
+	("presencia", "Sales Invoice", "facturasend_presencia", 1)
+]
+
+CLIENTE_FIELDS = [
+	("razonSocial", "Customer", "customer_name", None),
+	("nombreFantasia", "Customer", ("facturasend_nombre_fantasia", "customer_name"), None),
+	("tipoOperacion", "Customer", "facturasend_tipo_operacion", 1),
+	("pais", "Customer", "facturasend_pais", "PRY"),
+	("paisDescripcion", "Customer", "facturasend_pais_desc", "Paraguay"),
+	("tipoContribuyente", "Customer", "facturasend_tipo_contribuyente", 1),
+	("telefono", "Contact", "phone", ""),
+	("celular", "Contact", "mobile_no", ""),
+	("email", "Contact", "email_id", "")
+]
+
+# Solo para clientes contribuyentes
+CLIENTE_CONTRIBUYENTE_FIELDS = [
+	("ruc", "Customer", "facturasend_ruc", "")
+]
+
+# Solo para clientes no contribuyentes
+CLIENTE_NO_CONTRIBUYENTE_FIELDS = [
+	("documentoTipo", "Customer", "facturasend_documento_tipo", 1),
+	("documentoNumero", "Customer", "facturasend_documento_numero", "")
+]
+
+# Solo si el cliente tiene ciudad y distrito (obligatorios si tipoOperacion != 4)
+CLIENTE_UBICACION_FIELDS = [
+	("ciudad", "Customer", "facturasend_ciudad", None),
+	("ciudadDescripcion", "Customer", "facturasend_ciudad_desc", ""),
+	("distrito", "Customer", "facturasend_distrito", None),
+	("distritoDescripcion", "Customer", "facturasend_distrito_desc", "")
+]
+
+# Opcionales: solo si el cliente tiene departamento
+CLIENTE_DEPARTAMENTO_FIELDS = [
+	("departamento", "Customer", "facturasend_departamento", None),
+	("departamentoDescripcion", "Customer", "facturasend_departamento_desc", "")
+]
+
+USUARIO_FIELDS = [
+	("documentoTipo", "User", "facturasend_documento_tipo", 1),
+	("documentoNumero", "User", "facturasend_documento_numero", ""),
+	("nombre", "User", "full_name", None),
+	("cargo", "User", "facturasend_cargo", "")
+]
+
+ITEM_FIELDS = [
+	("codigo", "Sales Invoice Item", "item_code", None),
+	("descripcion", "Sales Invoice Item", ("description", "item_name"), None),
+	("cantidad", "Sales Invoice Item", "qty", 0),
+	("unidadMedida", "Item", "facturasend_unidad_medida", 77)
+]
+
+# Opcionales: solo se envían si tienen valor
+ITEM_OPTIONAL_FIELDS = [
+	("observacion", "Sales Invoice Item", "description", None),
+	("ncm", "Item", "facturasend_ncm", None)
+]
+
+# Valores fijos de cada item
+ITEM_CONSTANTS = {
+	"cambio": 0.0
+}
+
+ENTREGA_FIELDS = [
+	("tipo", "Sales Invoice", "facturasend_modo_pago", 1),
+	("moneda", "Sales Invoice", "currency", None)
+]
+
+# Secciones que se compilan, por nombre
+FIELD_SECTIONS = {
+	"documento": DOCUMENTO_FIELDS,
+	"factura": FACTURA_FIELDS,
+	"cliente": CLIENTE_FIELDS,
+	"cliente_contribuyente": CLIENTE_CONTRIBUYENTE_FIELDS,
+	"cliente_no_contribuyente": CLIENTE_NO_CONTRIBUYENTE_FIELDS,
+	"cliente_ubicacion": CLIENTE_UBICACION_FIELDS,
+	"cliente_departamento": CLIENTE_DEPARTAMENTO_FIELDS,
+	"usuario": USUARIO_FIELDS,
+	"item": ITEM_FIELDS,
+	"item_optional": ITEM_OPTIONAL_FIELDS,
+	"entrega": ENTREGA_FIELDS
+}
+
+# Tipo de documento electrónico
+TIPO_FACTURA = 1
+TIPO_NOTA_CREDITO = 5
+TIPO_NOTA_DEBITO = 4
+
+CURRENCY_DESCRIPTIONS = {
+	"PYG": "Guaraní",
+	"USD": "Dólar",
+	"EUR": "Euro",
+	"BRL": "Real"
+}
+
+PAYMENT_MODES = {
+	"Cash": 1,
+	"Efectivo": 1,
+	"Credit Card": 3,
+	"Tarjeta": 3,
+	"Cheque": 2,
+	"Bank Transfer": 4,
+	"Transferencia": 4
+}
+
+# Bloques `cliente` que se conservan por worker
+CLIENTE_CACHE_SIZE = 1000
+
+# Segundos que se conserva en Redis el JSON convertido de cada factura
+PAYLOAD_CACHE_TTL = 24 * 60 * 60
+
+# Secciones compiladas, una vez por worker
+_compiled_sections = None
+
+# Bloques `cliente` ya armados, del menos al más usado (LRU)
+_cliente_cache = OrderedDict()
+
+
+def convert_documents(docs, settings, prefetched=None):
+	"""Convierte muchos documentos a la vez al formato de FacturaSend
+
+	Precarga los datos relacionados de todos los documentos (si no vienen en
+	`prefetched`). Los documentos que no cambiaron desde la última conversión
+	(previsualización, envío o reintento) reutilizan el JSON guardado; el
+	resto se convierte con las secciones compiladas. Un error en un documento
+	no corta la conversión de los demás. Retorna `payloads` y `errors`,
+	ambos por nombre de documento.
+	"""
+
+	if prefetched is None:
+		prefetched = prefetch_conversion_data(docs)
+
+	fingerprints = {doc.name: get_payload_fingerprint(doc, settings, prefetched) for doc in docs}
+	payloads = get_cached_payloads(fingerprints)
+	errors = {}
+	sections = get_compiled_sections()
+
+	for doc in docs:
+		if doc.name in payloads:
+			continue
+
+		try:
+			payloads[doc.name] = build_payload(doc, settings, prefetched, sections)
+		except Exception as e:
+			frappe.log_error(frappe.get_traceback(), f"Error convirtiendo documento {doc.name}")
+			errors[doc.name] = str(e)
+			continue
+
+		cache_payload(doc.name, fingerprints[doc.name], payloads[doc.name])
+
+	return frappe._dict({"payloads": payloads, "errors": errors})
+
+
+def get_payload_fingerprint(doc, settings, prefetched):
+	"""Huella de todo lo que define el JSON de un documento
+
+	Incluye el `modified` de la factura y de su Customer, Contact, Address y
+	User, la configuración usada en la conversión y la versión de los datos
+	de items e impuestos. Si cualquiera cambia, la huella cambia.
+	"""
+
+	customer = prefetched.customers.get(doc.customer) or frappe._dict()
+	contact = prefetched.contacts.get(doc.customer) or frappe._dict()
+	address = prefetched.addresses.get(doc.customer) or frappe._dict()
+	user = prefetched.users.get(doc.owner) or frappe._dict()
+
+	parts = (
+		doc.modified,
+		settings.establecimiento,
+		settings.punto_expedicion,
+		customer.modified,
+		(contact.name, contact.modified),
+		(address.name, address.modified),
+		user.modified,
+		prefetched.catalog_version
+	)
+
+	return hashlib.md5(repr(parts).encode()).hexdigest()
+
+
+def get_cached_payloads(fingerprints):
+	"""JSON guardados de los documentos cuya huella no cambió"""
+
+	cache = frappe.cache()
+	payloads = {}
+
+	for name, fingerprint in fingerprints.items():
+		cached = cache.get_value(f"facturasend_payload:{name}")
+		if cached and cached["fingerprint"] == fingerprint:
+			payloads[name] = cached["payload"]
+
+	return payloads
+
+
+def cache_payload(name, fingerprint, payload):
+	"""Guarda el JSON convertido de un documento junto con su huella"""
+
+	frappe.cache().set_value(
+		f"facturasend_payload:{name}",
+		{"fingerprint": fingerprint, "payload": payload},
+		expires_in_sec=PAYLOAD_CACHE_TTL
+	)
+
+
+def build_payload(doc, settings, prefetched, sections):
+	"""JSON de FacturaSend de un documento"""
+
+	establecimiento, punto = extract_establecimiento_punto(doc.name, settings)
+	records = {"Sales Invoice": doc}
+
+	payload = {
+		"tipoDocumento": get_tipo_documento(doc),
+		"establecimiento": int(establecimiento),
+		"punto": str(punto).zfill(3),
+		"numero": extract_document_number(doc.name),
+		"fecha": doc.posting_date.strftime("%Y-%m-%dT%H:%M:%S") if isinstance(doc.posting_date, datetime) else f"{doc.posting_date}T00:00:00"
+	}
+	payload.update(apply_section(sections.documento, records))
+
+	payload["cliente"] = get_cliente(doc, prefetched, sections)
+	payload["usuario"] = apply_section(sections.usuario, {"User": prefetched.users.get(doc.owner) or frappe._dict()})
+	payload["factura"] = apply_section(sections.factura, records)
+	payload["condicion"] = build_condicion(doc, sections)
+	payload["items"] = [build_item(doc, item, prefetched, sections) for item in doc.items]
+
+	return payload
+
+
+def get_tipo_documento(doc):
+	"""Tipo de documento electrónico según los flags del Sales Invoice"""
+
+	if doc.is_debit_note:
+		return TIPO_NOTA_DEBITO
+	if doc.is_return:
+		return TIPO_NOTA_CREDITO
+	return TIPO_FACTURA
+
+
+def get_cliente(doc, prefetched, sections):
+	"""Sección `cliente` del documento, reutilizando la ya armada para el mismo cliente
+
+	Los bloques se guardan en un LRU del worker, con clave por sitio, cliente y
+	el `modified` de su Customer, Contact y Address principales. Al guardar
+	cualquiera de ellos (o cambiar el contacto o la dirección principal) la
+	clave cambia y el bloque se vuelve a armar; el viejo sale por LRU.
+	"""
+
+	customer = prefetched.customers.get(doc.customer)
+	if not customer:
+		frappe.throw(_(f"Cliente {doc.customer} no encontrado"))
+
+	contact = prefetched.contacts.get(customer.name)
+	address = prefetched.addresses.get(customer.name)
+	key = (
+		frappe.local.site,
+		customer.name,
+		customer.modified,
+		contact and (contact.name, contact.modified),
+		address and (address.name, address.modified)
+	)
+
+	cliente = _cliente_cache.get(key)
+	if cliente is None:
+		cliente = build_cliente(customer, contact, address, sections)
+		_cliente_cache[key] = cliente
+		if len(_cliente_cache) > CLIENTE_CACHE_SIZE:
+			_cliente_cache.popitem(last=False)
+	else:
+		_cliente_cache.move_to_end(key)
+
+	return dict(cliente)
+
+
+def build_cliente(customer, contact, address, sections):
+	"""Sección `cliente`, desde Customer y su Contact y Address principales"""
+
+	records = {
+		"Customer": customer,
+		"Contact": contact or frappe._dict()
+	}
+	es_contribuyente = customer.get("facturasend_contribuyente") == 1
+
+	cliente = {"contribuyente": es_contribuyente}
+	cliente.update(apply_section(sections.cliente, records))
+	cliente["codigo"] = get_codigo_cliente(customer, es_contribuyente)
+
+	if es_contribuyente:
+		cliente.update(apply_section(sections.cliente_contribuyente, records))
+	else:
+		cliente.update(apply_section(sections.cliente_no_contribuyente, records))
+
+	# Sin ciudad y distrito no se envían dirección ni ubicación
+	if not (customer.get("facturasend_ciudad") and customer.get("facturasend_distrito")):
+		return cliente
+
+	if address:
+		address_line = " ".join(filter(None, [address.get("address_line1"), address.get("address_line2")]))
+		if address_line:
+			cliente["direccion"] = address_line
+			cliente["numeroCasa"] = customer.get("facturasend_numero_casa") or "0"
+
+	cliente.update(apply_section(sections.cliente_ubicacion, records))
+
+	if customer.get("facturasend_departamento"):
+		cliente.update(apply_section(sections.cliente_departamento, records))
+
+	return cliente
+
+
+def get_codigo_cliente(customer, es_contribuyente):
+	"""Código del cliente (3-15 caracteres): RUC sin guión, documento o hash del nombre"""
+
+	if es_contribuyente and customer.get("facturasend_ruc"):
+		return customer.facturasend_ruc.replace("-", "")[:15]
+	if customer.get("facturasend_documento_numero"):
+		return customer.facturasend_documento_numero[:15]
+	return hashlib.md5(customer.name.encode()).hexdigest()[:10]
+
+
+def build_item(doc, item, prefetched, sections):
+	"""Un elemento de `items`, desde la fila de la factura y su Item"""
+
+	records = {
+		"Sales Invoice Item": item,
+		"Item": prefetched.item_records.get(item.item_code) or frappe._dict()
+	}
+
+	item_data = apply_section(sections.item, records)
+	item_data.update(ITEM_CONSTANTS)
+	item_data.update(get_item_iva(item, records["Item"], prefetched.iva_table))
+
+	# Para PYG, sin decimales
+	item_data["precioUnitario"] = int(round(item.rate)) if doc.currency == "PYG" else item.rate
+	item_data["extras"] = {"barCode": records["Item"].get("barcode") or item.item_code}
+
+	for key, getter in sections.item_optional:
+		value = getter(records)
+		if value:
+			item_data[key] = value
+
+	return item_data
+
+
+def build_condicion(doc, sections):
+	"""Sección `condicion`: contado, o crédito si la factura tiene cuotas"""
+
+	entrega = apply_section(sections.entrega, {"Sales Invoice": doc})
+	# Para PYG, monto como string sin decimales
+	entrega["monto"] = str(int(round(doc.grand_total))) if doc.currency == "PYG" else str(doc.grand_total)
+	entrega["monedaDescripcion"] = get_currency_description(doc.currency)
+	entrega["cambio"] = 0.0
+
+	condicion = {"tipo": 1, "entregas": [entrega]}
+
+	if not doc.payment_schedule:
+		return condicion
+
+	ultima_fecha = doc.payment_schedule[-1].due_date
+	if hasattr(ultima_fecha, "toordinal"):
+		dias_plazo = ultima_fecha.toordinal() - getdate(doc.posting_date).toordinal()
+	else:
+		dias_plazo = 30
+
+	condicion["tipo"] = 2
+	condicion["credito"] = {
+		"tipo": 1,  # Plazo
+		"plazo": f"{dias_plazo} días",
+		"cuotas": len(doc.payment_schedule),
+		"montoEntrega": 0 if doc.currency == "PYG" else 0.0,
+		"infoCuotas": [
+			{
+				"moneda": doc.currency,
+				"monto": int(round(cuota.payment_amount)) if doc.currency == "PYG" else cuota.payment_amount
+			}
+			for cuota in doc.payment_schedule
+		]
+	}
+
+	return condicion
+
+
+def apply_section(section, records):
+	"""Arma un diccionario de FacturaSend con una sección compilada"""
+
+	return {key: getter(records) for key, getter in section}
+
+
+def get_compiled_sections():
+	"""Secciones del mapeo compiladas a funciones, una vez por worker"""
+
+	global _compiled_sections
+
+	if _compiled_sections is None:
+		select_codes = get_select_codes()
+		_compiled_sections = frappe._dict({
+			name: [(key, compile_field(doctype, field, default, select_codes)) for key, doctype, field, default in fields]
+			for name, fields in FIELD_SECTIONS.items()
+		})
+
+	return _compiled_sections
+
+
+def compile_field(doctype, field, default, select_codes):
+	"""Función que lee un campo del mapeo desde los registros de un documento
+
+	Con una tupla de campos se usa el primero con valor. Los campos Select de
+	los fixtures se traducen con su tabla de códigos; un valor que no está en
+	la tabla se interpreta con `extract_number`.
+	"""
+
+	fields = field if isinstance(field, tuple) else (field,)
+	codes = select_codes.get((doctype, fields[0]))
+
+	if codes is not None:
+		fieldname = fields[0]
+
+		def get_select(records):
+			value = records[doctype].get(fieldname)
+			if not value:
+				return default
+			code = codes.get(value)
+			return code if code is not None else extract_number(value)
+
+		return get_select
+
+	if len(fields) == 1:
+		fieldname = fields[0]
+		return lambda records: records[doctype].get(fieldname) or default
+
+	def get_first(records):
+		record = records[doctype]
+		for fieldname in fields:
+			value = record.get(fieldname)
+			if value:
+				return value
+		return default
+
+	return get_first
+
+
+def get_select_codes():
+	"""Tablas de códigos de los campos Select de los fixtures
+
+	Retorna {(DocType, campo): {"1 - Normal": 1, ...}} para los Select cuyas
+	opciones tienen la forma "código - descripción".
+	"""
+
+	from facturasend_integration.install import get_fixture_fields
+
+	select_codes = {}
+	for doctype, fields in get_fixture_fields().items():
+		for field in fields:
+			if field.get("fieldtype") != "Select":
+				continue
+
+			codes = {}
+			for option in (field.get("options") or "").split("\n"):
+				code = option.split("-")[0].strip()
+				if code.isdigit():
+					codes[option] = int(code)
+
+			if codes:
+				select_codes[(doctype, field["fieldname"])] = codes
+
+	return select_codes
+
+
+# Funciones auxiliares
+
+def extract_establecimiento_punto(doc_name, settings):
+	"""Extrae establecimiento y punto de expedición de la serie del documento"""
+
+	# Formato esperado: FC-001-001-.#######
+	parts = doc_name.split('-')
+
+	if len(parts) >= 3:
+		establecimiento = parts[1]
+		punto = str(parts[2]).zfill(3)  # Asegurar formato "001"
+	else:
+		# Usar valores por defecto de la configuración
+		establecimiento = settings.establecimiento
+		punto = str(settings.punto_expedicion).zfill(3)
+
+	return establecimiento, punto
+
+
+def extract_document_number(doc_name):
+	"""Extrae el número del documento de la serie"""
+
+	# Formato esperado: FC-001-001-.#######
+	parts = doc_name.split('-')
+
+	if len(parts) >= 4:
+		# El último elemento debería ser el número
+		try:
+			return int(parts[-1])
+		except ValueError:
+			return 1
+
+	return 1
+
+
+def extract_number(value):
+	"""Extrae el número de un string tipo '1 - Descripción'"""
+
+	if isinstance(value, int):
+		return value
+
+	if isinstance(value, str):
+		try:
+			return int(value.split('-')[0].strip())
+		except ValueError:
+			return 1
+
+	return 1
+
+
+def map_payment_mode_to_fs(mode_of_payment):
+	"""Mapea modo de pago de ERPNext a tipo de FacturaSend"""
+
+	return PAYMENT_MODES.get(mode_of_payment, 1)
+
+
+def get_currency_description(currency):
+	"""Obtiene la descripción de la moneda"""
+
+	return CURRENCY_DESCRIPTIONS.get(currency, currency)
@@ -1,6 +1,13 @@
 // Copyright (c) 2025, Luis and contributors
 // For license information, please see license.txt
 
+// Alto de cada fila de la grilla (px); la grilla solo dibuja las filas visibles
+const FS_ROW_HEIGHT = 36;
+// Filas extra dibujadas arriba y abajo del área visible
+const FS_ROW_BUFFER = 10;
+// Documentos por página pedidos al servidor
+const FS_PAGE_LENGTH = 100;
+
 frappe.ui.form.on('FacturaSend Queue', {
 	refresh: function(frm) {
 		// Botón para cargar documentos pendientes
@@ -32,127 +39,271 @@ frappe.ui.form.on('FacturaSend Queue', {
 		if (!frm.doc.__islocal) {
 			load_pending_documents(frm);
 		}
+	},
+
+	tipo_documento: function(frm) {
+		load_pending_documents(frm);
+	},
+
+	estado: function(frm) {
+		load_pending_documents(frm);
+	},
+
+	customer: function(frm) {
+		load_pending_documents(frm);
+	},
+
+	desde_fecha: function(frm) {
+		load_pending_documents(frm);
+	},
+
+	hasta_fecha: function(frm) {
+		load_pending_documents(frm);
 	}
 });
 
 function load_pending_documents(frm) {
+	// Reiniciar la grilla y pedir la primera página
+	frm.facturasend_grid = {
+		documents: [],
+		selected: {},
+		counts: {},
+		next_cursor: null,
+		loading: false,
+		request_id: (frm.facturasend_grid ? frm.facturasend_grid.request_id : 0) + 1
+	};
+
+	setup_document_grid(frm);
+	fetch_next_page(frm);
+}
+
+function fetch_next_page(frm) {
+	let grid = frm.facturasend_grid;
+	if (grid.loading) {
+		return;
+	}
+
+	grid.loading = true;
+	let request_id = grid.request_id;
+
 	frappe.call({
-		method: 'facturasend_integration.facturasend_integration.api.get_pending_documents',
+		method: 'facturasend_integration.facturasend_integration.api.get_queue_page',
 		args: {
 			tipo_documento: frm.doc.tipo_documento,
+			estado: frm.doc.estado,
+			customer: frm.doc.customer,
 			desde_fecha: frm.doc.desde_fecha,
-			hasta_fecha: frm.doc.hasta_fecha
+			hasta_fecha: frm.doc.hasta_fecha,
+			cursor: grid.next_cursor,
+			page_length: FS_PAGE_LENGTH
 		},
 		callback: function(r) {
-			if (r.message) {
-				render_document_list(frm, r.message);
+			// Ignorar respuestas de una carga anterior (filtros cambiados)
+			if (request_id !== frm.facturasend_grid.request_id) {
+				return;
+			}
+
+			grid.loading = false;
+			if (!r.message) {
+				return;
 			}
+
+			if (r.message.counts) {
+				grid.counts = r.message.counts;
+			}
+			grid.documents = grid.documents.concat(r.message.documents || []);
+			grid.next_cursor = r.message.next_cursor;
+
+			render_document_list(frm);
+		},
+		error: function() {
+			grid.loading = false;
 		}
 	});
 }
 
-function render_document_list(frm, documents) {
-	if (!documents || documents.length === 0) {
-		frappe.msgprint(__('No se encontraron documentos'));
-		return;
-	}
+function setup_document_grid(frm) {
+	let $wrapper = frm.fields_dict.documents_html.$wrapper;
 
-	let html = `
+	$wrapper.html(`
 		<div class="facturasend-documents">
-			<p><strong>${documents.length} documento(s) encontrado(s)</strong></p>
-			<table class="table table-bordered">
-				<thead>
-					<tr>
-						<th><input type="checkbox" id="select-all"></th>
-						<th>Documento</th>
-						<th>Cliente</th>
-						<th>Fecha</th>
-						<th>Total</th>
-						<th>Estado FS</th>
-						<th>CDC</th>
-						<th>Acciones</th>
-					</tr>
-				</thead>
-				<tbody id="documents-tbody">
-	`;
+			<div class="facturasend-summary"></div>
+			<div class="facturasend-grid-header facturasend-grid-row">
+				<div><input type="checkbox" class="select-all"></div>
+				<div>Documento</div>
+				<div>Cliente</div>
+				<div>Fecha</div>
+				<div>Total</div>
+				<div>Estado FS</div>
+				<div>CDC</div>
+				<div>Acciones</div>
+			</div>
+			<div class="facturasend-grid-viewport">
+				<div class="facturasend-grid-spacer"></div>
+				<div class="facturasend-grid-rows"></div>
+			</div>
+		</div>
+	`);
+
+	// Los handlers se delegan una sola vez en el contenedor, no por fila
+	$wrapper.off('.facturasend');
+
+	$wrapper.on('change.facturasend', '.select-all', function() {
+		let grid = frm.facturasend_grid;
+		let checked = $(this).is(':checked');
+		grid.documents.forEach(function(doc) {
+			if (checked) {
+				grid.selected[doc.name] = {doctype: doc.doctype, name: doc.name};
+			} else {
+				delete grid.selected[doc.name];
+			}
+		});
+		render_visible_rows(frm);
+		render_summary(frm);
+	});
 
-	documents.forEach(function(doc) {
-		let status_badge = '';
-		if (doc.facturasend_estado) {
-			let color = doc.facturasend_estado === 'Aprobado' ? 'green' : 
-			           doc.facturasend_estado === 'Rechazado' ? 'red' : 
-			           doc.facturasend_estado === 'Error' ? 'orange' : 'blue';
-			status_badge = `<span class="badge" style="background-color: ${color}">${doc.facturasend_estado}</span>`;
+	$wrapper.on('change.facturasend', '.doc-checkbox', function() {
+		let grid = frm.facturasend_grid;
+		let name = $(this).data('name');
+		if ($(this).is(':checked')) {
+			grid.selected[name] = {doctype: $(this).data('doctype'), name: name};
 		} else {
-			status_badge = `<span class="badge" style="background-color: gray">Pendiente</span>`;
+			delete grid.selected[name];
 		}
+		render_summary(frm);
+	});
 
-		let retry_btn = '';
-		if (doc.facturasend_estado === 'Error' || doc.facturasend_estado === 'Rechazado') {
-			retry_btn = `<button class="btn btn-xs btn-warning retry-btn" data-doctype="${doc.doctype}" data-name="${doc.name}">Reintentar</button>`;
-		}
+	$wrapper.on('click.facturasend', '.retry-btn', function() {
+		retry_document($(this).data('doctype'), $(this).data('name'));
+	});
 
-		html += `
-			<tr>
-				<td><input type="checkbox" class="doc-checkbox" data-doctype="${doc.doctype}" data-name="${doc.name}"></td>
-				<td><a href="/app/${doc.doctype.toLowerCase().replace(/ /g, '-')}/${doc.name}">${doc.name}</a></td>
-				<td>${doc.customer_name || ''}</td>
-				<td>${doc.posting_date || ''}</td>
-				<td>${format_currency(doc.grand_total || 0, doc.currency)}</td>
-				<td>${status_badge}</td>
-				<td>${doc.facturasend_cdc || ''}</td>
-				<td>${retry_btn}</td>
-			</tr>
-		`;
+	$wrapper.on('click.facturasend', '.estado-count', function() {
+		frm.set_value('estado', $(this).data('estado') || '');
 	});
 
-	html += `
-				</tbody>
-			</table>
-		</div>
-	`;
+	let scheduled = false;
+	$wrapper.find('.facturasend-grid-viewport').on('scroll', function() {
+		if (scheduled) {
+			return;
+		}
+		scheduled = true;
+		window.requestAnimationFrame(function() {
+			scheduled = false;
+			render_visible_rows(frm);
+			maybe_fetch_more(frm);
+		});
+	});
+}
 
-	// Usar el campo HTML documents_html
-	frm.fields_dict.documents_html.$wrapper.html(html);
+function render_document_list(frm) {
+	let grid = frm.facturasend_grid;
+	let $wrapper = frm.fields_dict.documents_html.$wrapper;
 
-	// Event handlers - usar setTimeout para asegurar que el DOM esté listo
-	setTimeout(function() {
-		$('#select-all').on('change', function() {
-			$('.doc-checkbox').prop('checked', $(this).is(':checked'));
-		});
+	$wrapper.find('.facturasend-grid-spacer').css('height', grid.documents.length * FS_ROW_HEIGHT);
 
-		$('.retry-btn').on('click', function() {
-			let doctype = $(this).data('doctype');
-			let name = $(this).data('name');
-			retry_document(doctype, name);
-		});
-	}, 100);
+	render_summary(frm);
+	render_visible_rows(frm);
+	maybe_fetch_more(frm);
 }
 
-function send_selected_documents(frm) {
-	let selected = [];
-	$('.doc-checkbox:checked').each(function() {
-		selected.push({
-			doctype: $(this).data('doctype'),
-			name: $(this).data('name')
-		});
-	});
+function render_summary(frm) {
+	let grid = frm.facturasend_grid;
+	let $summary = frm.fields_dict.documents_html.$wrapper.find('.facturasend-summary');
 
-	if (selected.length === 0) {
-		frappe.msgprint(__('Por favor seleccione al menos un documento'));
+	let total = Object.values(grid.counts).reduce((a, b) => a + b, 0);
+	let counts_html = Object.keys(grid.counts).sort().map(function(estado) {
+		return `<a class="estado-count" data-estado="${estado}">${estado}: <strong>${grid.counts[estado]}</strong></a>`;
+	}).join(' · ');
+
+	$summary.html(`
+		<p>
+			<a class="estado-count" data-estado=""><strong>${total} documento(s) encontrado(s)</strong></a>
+			${counts_html ? ' — ' + counts_html : ''}
+		</p>
+		<p class="text-muted">
+			${grid.documents.length} cargado(s), ${Object.keys(grid.selected).length} seleccionado(s)
+		</p>
+	`);
+}
+
+function render_visible_rows(frm) {
+	let grid = frm.facturasend_grid;
+	let $viewport = frm.fields_dict.documents_html.$wrapper.find('.facturasend-grid-viewport');
+	let $rows = $viewport.find('.facturasend-grid-rows');
+
+	if (!grid.documents.length) {
+		$rows.css('transform', 'translateY(0px)').html(
+			grid.loading ? '' : `<div class="text-muted facturasend-grid-empty">${__('No se encontraron documentos')}</div>`
+		);
 		return;
 	}
 
-	if (selected.length > 50) {
-		frappe.msgprint(__('No puede enviar más de 50 documentos a la vez'));
+	let scroll_top = $viewport.scrollTop();
+	let first = Math.max(0, Math.floor(scroll_top / FS_ROW_HEIGHT) - FS_ROW_BUFFER);
+	let visible = Math.ceil($viewport.height() / FS_ROW_HEIGHT) + 2 * FS_ROW_BUFFER;
+	let last = Math.min(grid.documents.length, first + visible);
+
+	let html = '';
+	for (let i = first; i < last; i++) {
+		html += render_document_row(grid.documents[i], !!grid.selected[grid.documents[i].name]);
+	}
+
+	$rows.css('transform', `translateY(${first * FS_ROW_HEIGHT}px)`).html(html);
+}
+
+function render_document_row(doc, checked) {
+	let status_badge = '';
+	if (doc.facturasend_estado) {
+		let color = doc.facturasend_estado === 'Aprobado' ? 'green' : 
+		           doc.facturasend_estado === 'Rechazado' ? 'red' : 
+		           doc.facturasend_estado === 'Error' ? 'orange' : 'blue';
+		status_badge = `<span class="badge" style="background-color: ${color}">${doc.facturasend_estado}</span>`;
+	} else {
+		status_badge = `<span class="badge" style="background-color: gray">Pendiente</span>`;
+	}
+
+	let retry_btn = '';
+	if (doc.facturasend_estado === 'Error' || doc.facturasend_estado === 'Rechazado') {
+		retry_btn = `<button class="btn btn-xs btn-warning retry-btn" data-doctype="${doc.doctype}" data-name="${doc.name}">Reintentar</button>`;
+	}
+
+	return `
+		<div class="facturasend-grid-row">
+			<div><input type="checkbox" class="doc-checkbox" data-doctype="${doc.doctype}" data-name="${doc.name}" ${checked ? 'checked' : ''}></div>
+			<div><a href="/app/sales-invoice/${doc.name}">${doc.name}</a></div>
+			<div>${doc.customer_name || ''}</div>
+			<div>${doc.posting_date || ''}</div>
+			<div>${format_currency(doc.grand_total || 0, doc.currency)}</div>
+			<div>${status_badge}</div>
+			<div>${doc.facturasend_cdc || ''}</div>
+			<div>${retry_btn}</div>
+		</div>
+	`;
+}
+
+function maybe_fetch_more(frm) {
+	let grid = frm.facturasend_grid;
+	if (!grid.next_cursor || grid.loading) {
 		return;
 	}
 
-	// Validar que todos sean del mismo tipo
-	let tipo = selected[0].doctype;
-	let all_same = selected.every(doc => doc.doctype === tipo);
-	if (!all_same) {
-		frappe.msgprint(__('Todos los documentos deben ser del mismo tipo'));
+	// Pedir la siguiente página cuando faltan menos de dos pantallas por recorrer
+	let $viewport = frm.fields_dict.documents_html.$wrapper.find('.facturasend-grid-viewport');
+	let remaining = grid.documents.length * FS_ROW_HEIGHT - $viewport.scrollTop() - $viewport.height();
+	if (remaining < 2 * $viewport.height()) {
+		fetch_next_page(frm);
+	}
+}
+
+function get_selected_documents(frm) {
+	return Object.values(frm.facturasend_grid ? frm.facturasend_grid.selected : {});
+}
+
+function send_selected_documents(frm) {
+	let selected = get_selected_documents(frm);
+
+	if (selected.length === 0) {
+		frappe.msgprint(__('Por favor seleccione al menos un documento'));
 		return;
 	}
 
@@ -160,66 +311,19 @@ function send_selected_documents(frm) {
 		__('¿Está seguro de enviar {0} documento(s) a FacturaSend?', [selected.length]),
 		function() {
 			frappe.call({
-				method: 'facturasend_integration.facturasend_integration.api.send_batch_to_facturasend',
+				method: 'facturasend_integration.facturasend_integration.jobs.enqueue_documents',
 				args: {
 					documents: selected
 				},
 				callback: function(r) {
 					if (r.message && r.message.success) {
-						frappe.msgprint(__('Documentos enviados exitosamente'));
-						load_pending_documents(frm);
-						
-						// Descargar KUDEs automáticamente si hay CDCs
-						// Esperar más tiempo para que FacturaSend procese los XML
-						if (r.message.cdcs && r.message.cdcs.length > 0) {
-							frappe.show_alert({
-								message: __('Los KUDEs se descargarán automáticamente en 5 segundos...'),
-								indicator: 'blue'
-							});
-							setTimeout(function() {
-								download_kude_by_cdcs(r.message.cdcs);
-							}, 5000);
-						}
-					} else {
-						// Construir mensaje de error detallado
-						let error_html = '<div style="max-height: 400px; overflow-y: auto;">';
-						error_html += '<p><strong>' + (r.message.error || 'Error desconocido') + '</strong></p>';
-						
-						// Si hay errores detallados del API
-						if (r.message.errores && r.message.errores.length > 0) {
-							error_html += '<div class="alert alert-danger"><strong>Errores de FacturaSend:</strong><ul>';
-							r.message.errores.forEach(function(err) {
-								error_html += '<li><strong>Documento ' + err.index + ':</strong> ' + err.error + '</li>';
-							});
-							error_html += '</ul></div>';
-						}
-						
-						// Si hay detalles adicionales de conversión
-						if (r.message.details && r.message.details.length > 0) {
-							error_html += '<div class="alert alert-warning"><strong>Detalles:</strong><ul>';
-							r.message.details.forEach(function(detail) {
-								error_html += '<li>' + detail + '</li>';
-							});
-							error_html += '</ul></div>';
-						}
-						
-						error_html += '</div>';
-						
-						frappe.msgprint({
-							title: __('Error al enviar documentos'),
-							message: error_html,
-							indicator: 'red',
-							primary_action: {
-								label: __('Ver en Consola'),
-								action: function() {
-									console.error('FacturaSend Error:', r.message);
-									frappe.msgprint(__('Error mostrado en la consola del navegador'));
-								}
-							}
+						track_send_progress(frm, r.message);
+						frappe.show_alert({
+							message: __('{0} documento(s) encolados en {1} lote(s)', [r.message.document_count, r.message.lotes]),
+							indicator: 'blue'
 						});
-						
-						// También mostrar en consola para debugging
-						console.error('FacturaSend Error:', r.message);
+					} else {
+						show_send_error(r.message || {});
 					}
 				}
 			});
@@ -227,6 +331,102 @@ function send_selected_documents(frm) {
 	);
 }
 
+function track_send_progress(frm, send) {
+	// Los lotes se envían en segundo plano; el servidor publica el avance de cada uno
+	let failed = [];
+	let cdcs = [];
+
+	let handler = function(data) {
+		if (data.request_id !== send.request_id) {
+			return;
+		}
+
+		if (data.success) {
+			cdcs = cdcs.concat(data.cdcs || []);
+		} else {
+			failed.push(data);
+		}
+
+		frappe.show_progress(
+			__('Enviando a FacturaSend'),
+			data.completed_lotes,
+			data.total_lotes,
+			__('Lote {0} de {1}', [data.completed_lotes, data.total_lotes])
+		);
+
+		if (data.completed_lotes < data.total_lotes) {
+			return;
+		}
+
+		frappe.realtime.off('facturasend_send_progress', handler);
+		frappe.hide_progress();
+		load_pending_documents(frm);
+
+		if (failed.length) {
+			failed.forEach(show_send_error);
+			return;
+		}
+
+		frappe.msgprint(__('Documentos enviados exitosamente'));
+
+		// Descargar KUDEs automáticamente si hay CDCs
+		// Esperar más tiempo para que FacturaSend procese los XML
+		if (cdcs.length > 0) {
+			frappe.show_alert({
+				message: __('Los KUDEs se descargarán automáticamente en 5 segundos...'),
+				indicator: 'blue'
+			});
+			setTimeout(function() {
+				download_kude_by_cdcs(cdcs);
+			}, 5000);
+		}
+	};
+
+	frappe.realtime.on('facturasend_send_progress', handler);
+}
+
+function show_send_error(message) {
+	// Construir mensaje de error detallado
+	let error_html = '<div style="max-height: 400px; overflow-y: auto;">';
+	error_html += '<p><strong>' + (message.error || 'Error desconocido') + '</strong></p>';
+	
+	// Si hay errores detallados del API
+	if (message.errores && message.errores.length > 0) {
+		error_html += '<div class="alert alert-danger"><strong>Errores de FacturaSend:</strong><ul>';
+		message.errores.forEach(function(err) {
+			error_html += '<li><strong>Documento ' + err.index + ':</strong> ' + err.error + '</li>';
+		});
+		error_html += '</ul></div>';
+	}
+	
+	// Si hay detalles adicionales de conversión
+	if (message.details && message.details.length > 0) {
+		error_html += '<div class="alert alert-warning"><strong>Detalles:</strong><ul>';
+		message.details.forEach(function(detail) {
+			error_html += '<li>' + detail + '</li>';
+		});
+		error_html += '</ul></div>';
+	}
+	
+	error_html += '</div>';
+	
+	frappe.msgprint({
+		title: __('Error al enviar documentos'),
+		message: error_html,
+		indicator: 'red',
+		primary_action: {
+			label: __('Ver en Consola'),
+			action: function() {
+				console.error('FacturaSend Error:', message);
+				frappe.msgprint(__('Error mostrado en la consola del navegador'));
+			}
+		}
+	});
+	
+	// También mostrar en consola para debugging
+	console.error('FacturaSend Error:', message);
+}
+
 function retry_document(doctype, name) {
 	frappe.confirm(
 		__('¿Reintentar envío del documento {0}?', [name]),
@@ -250,54 +450,98 @@ function retry_document(doctype, name) {
 }
 
 function download_kudes(frm) {
-	let selected = [];
-	$('.doc-checkbox:checked').each(function() {
-		selected.push({
-			doctype: $(this).data('doctype'),
-			name: $(this).data('name')
-		});
-	});
+	let selected = get_selected_documents(frm);
 
 	if (selected.length === 0) {
 		frappe.msgprint(__('Por favor seleccione al menos un documento'));
 		return;
 	}
 
+	frappe.prompt({
+		fieldname: 'output',
+		fieldtype: 'Select',
+		label: __('Formato'),
+		options: [
+			{value: 'pdf', label: __('Un solo PDF')},
+			{value: 'zip', label: __('ZIP con un PDF por documento')}
+		],
+		default: 'pdf'
+	}, function(values) {
+		start_kude_download({documents: selected, output: values.output});
+	}, __('Descargar KUDEs'), __('Descargar'));
+}
+
+function start_kude_download(args) {
+	// El archivo se arma en segundo plano; el servidor publica el avance de la descarga
 	frappe.call({
-		method: 'facturasend_integration.facturasend_integration.api.download_batch_kude',
-		args: {
-			documents: selected
-		},
+		method: 'facturasend_integration.facturasend_integration.kude.enqueue_kude_download',
+		args: args,
 		callback: function(r) {
 			if (r.message && r.message.success) {
-				// Descargar PDF en lugar de abrirlo
-				let timestamp = new Date().getTime();
-				let link = document.createElement('a');
-				link.href = r.message.pdf_url;
-				link.download = `KUDEs_${timestamp}.pdf`;
-				document.body.appendChild(link);
-				link.click();
-				document.body.removeChild(link);
-				
-				frappe.show_alert({
-					message: __('KUDEs descargados exitosamente'),
-					indicator: 'green'
-				});
+				track_kude_download(r.message);
 			} else {
-				frappe.msgprint(__('Error al descargar KUDEs: ') + (r.message.error || 'Error desconocido'));
+				frappe.msgprint(__('Error al descargar KUDEs: ') + ((r.message && r.message.error) || 'Error desconocido'));
 			}
 		}
 	});
 }
 
-function preview_json(frm) {
-	let selected = [];
-	$('.doc-checkbox:checked').each(function() {
-		selected.push({
-			doctype: $(this).data('doctype'),
-			name: $(this).data('name')
+function track_kude_download(download) {
+	let handler = function(data) {
+		if (data.request_id !== download.request_id) {
+			return;
+		}
+
+		if (!data.finished) {
+			frappe.show_progress(
+				__('Descargando KUDEs'),
+				data.done,
+				data.total,
+				__('{0} de {1} documentos', [data.done, data.total])
+			);
+			return;
+		}
+
+		frappe.realtime.off('facturasend_kude_progress', handler);
+		frappe.hide_progress();
+
+		if (!data.success) {
+			show_kude_error(data.error || 'Error desconocido');
+			return;
+		}
+
+		// Descargar el archivo en lugar de abrirlo
+		let link = document.createElement('a');
+		link.href = data.file_url;
+		link.download = data.file_name;
+		document.body.appendChild(link);
+		link.click();
+		document.body.removeChild(link);
+
+		frappe.show_alert({
+			message: __('KUDEs descargados exitosamente'),
+			indicator: 'green'
 		});
-	});
+	};
+
+	frappe.realtime.on('facturasend_kude_progress', handler);
+}
+
+function show_kude_error(error_msg) {
+	// Mostrar error más amigable
+	if (error_msg.includes('No se encontraron')) {
+		frappe.msgprint({
+			title: __('KUDEs no disponibles aún'),
+			message: __('Los documentos electrónicos aún se están procesando en FacturaSend. Por favor intente descargar los KUDEs manualmente en unos momentos usando el botón "Descargar KUDEs".'),
+			indicator: 'orange'
+		});
+	} else {
+		frappe.msgprint(__('Error al descargar KUDEs: ') + error_msg);
+	}
+}
+
+function preview_json(frm) {
+	let selected = get_selected_documents(frm);
 
 	if (selected.length === 0) {
 		frappe.msgprint(__('Por favor seleccione al menos un documento'));
@@ -365,7 +609,7 @@ function preview_json(frm) {
 
 function reset_retries(frm) {
 	// Obtener documentos seleccionados
-	let selected = get_selected_documents();
+	let selected = get_selected_documents(frm);
 	
 	if (selected.length === 0) {
 		frappe.msgprint(__('Por favor seleccione al menos un documento'));
@@ -403,39 +647,5 @@ function reset_retries(frm) {
 }
 
 function download_kude_by_cdcs(cdcs) {
-	frappe.call({
-		method: 'facturasend_integration.facturasend_integration.api.download_kude_by_cdc',
-		args: {
-			cdcs: cdcs
-		},
-		callback: function(r) {
-			if (r.message && r.message.pdf_url) {
-				// Descargar PDF en lugar de abrirlo
-				let timestamp = new Date().getTime();
-				let link = document.createElement('a');
-				link.href = r.message.pdf_url;
-				link.download = `KUDEs_${timestamp}.pdf`;
-				document.body.appendChild(link);
-				link.click();
-				document.body.removeChild(link);
-				
-				frappe.show_alert({
-					message: __('KUDEs descargados exitosamente'),
-					indicator: 'green'
-				});
-			} else if (r.message && r.message.error) {
-				// Mostrar error más amigable
-				let error_msg = r.message.error;
-				if (error_msg.includes('No se encontraron')) {
-					frappe.msgprint({
-						title: __('KUDEs no disponibles aún'),
-						message: __('Los documentos electrónicos aún se están procesando en FacturaSend. Por favor intente descargar los KUDEs manualmente en unos momentos usando el botón "Descargar KUDEs".'),
-						indicator: 'orange'
-					});
-				} else {
-					frappe.msgprint(__('Error al descargar KUDEs: ') + error_msg);
-				}
-			}
-		}
-	});
+	start_kude_download({cdcs: cdcs});
 }
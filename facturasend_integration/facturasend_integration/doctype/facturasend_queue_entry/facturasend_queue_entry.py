@@ -0,0 +1,15 @@
+# Copyright (c) 2025, Luis and contributors
+# For license information, please see license.txt
+
+import frappe
+from frappe.model.document import Document
+
+
+class FacturaSendQueueEntry(Document):
+	pass
+
+
+def on_doctype_update():
+	"""Índice para tomar trabajo de la cola por estado y próximo intento"""
+
+	frappe.db.add_index("FacturaSend Queue Entry", ["state", "next_attempt"])
@@ -3,7 +3,10 @@
 
 import frappe
 from frappe.model.document import Document
+from facturasend_integration.facturasend_integration.settings import clear_settings_cache
 
 
 class FacturaSendSettings(Document):
-	pass
+	def on_update(self):
+		# Los workers descartan la configuración y credenciales cacheadas
+		clear_settings_cache()
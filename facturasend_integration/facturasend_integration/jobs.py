@@ -0,0 +1,319 @@
+# Copyright (c) 2025, Luis and contributors
+# For license information, please see license.txt
+
+import json
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import frappe
+from frappe.utils import add_to_date, cint, now_datetime
+from facturasend_integration.facturasend_integration.api import (
+	complete_empty_lote,
+	complete_lote,
+	get_document_type,
+	log_lote_request,
+	log_lote_response,
+	post_lote,
+	prepare_lote
+)
+from facturasend_integration.facturasend_integration.client import get_client
+from facturasend_integration.facturasend_integration.logger import get_logger
+from facturasend_integration.facturasend_integration.send_queue import (
+	QUEUE_PENDING,
+	enqueue_for_send,
+	fail_interrupted_sends,
+	get_claimable_entries
+)
+from facturasend_integration.facturasend_integration.settings import get_facturasend_settings
+
+
+# Máximo de documentos por lote que acepta FacturaSend
+LOTE_SIZE = 50
+
+# Lotes por job de envío: un envío grande se reparte en varios jobs, así la
+# cantidad de lotes en vuelo crece con los workers de la cola `long` (el ritmo
+# total lo sigue limitando el limitador de solicitudes compartido en Redis)
+LOTES_PER_JOB = 20
+
+# Evento realtime con el avance de un envío en segundo plano
+SEND_PROGRESS_EVENT = "facturasend_send_progress"
+
+# Segundos que se guarda en Redis el avance de un envío
+PROGRESS_TTL = 24 * 60 * 60
+
+# Segundos que se esperan otros documentos antes de enviar los encolados al emitirse
+DEFAULT_AUTO_BATCH_WAIT = 10
+
+# Segundos entre revisiones de la cola mientras se juntan documentos
+AUTO_FLUSH_POLL_SECONDS = 1
+
+
+@frappe.whitelist()
+def enqueue_documents(documents):
+	"""Encola el envío de cualquier cantidad de documentos a FacturaSend
+
+	Agrupa los documentos por tipo (factura, nota de crédito, nota de débito),
+	los divide en lotes de hasta 50 y los envía desde jobs en segundo plano de
+	hasta `LOTES_PER_JOB` lotes, cada uno con varios lotes en paralelo. El
+	avance se informa con el evento realtime `facturasend_send_progress`.
+	"""
+
+	if isinstance(documents, str):
+		documents = json.loads(documents)
+
+	if not documents:
+		return {"success": False, "error": "No hay documentos para enviar"}
+
+	lotes = split_into_lotes(documents)
+	request_id = frappe.generate_hash(length=12)
+	timeout = max(1500, len(lotes) * 60)
+
+	# Reservados para este envío mientras duren los jobs; si no llegan a
+	# ejecutarse, el envío programado los toma al vencer la reserva
+	enqueue_for_send(documents, commit=False, lease_owner=request_id, lease_seconds=timeout)
+
+	for start in range(0, len(lotes), LOTES_PER_JOB):
+		shard = lotes[start:start + LOTES_PER_JOB]
+		frappe.enqueue(
+			"facturasend_integration.facturasend_integration.jobs.dispatch_lotes_job",
+			queue="long",
+			timeout=max(1500, len(shard) * 60),
+			enqueue_after_commit=True,
+			lotes=shard,
+			request_id=request_id,
+			first_lote=start + 1,
+			total_lotes=len(lotes)
+		)
+
+	get_logger().info(f"Envío {request_id}: {len(documents)} documentos encolados en {len(lotes)} lotes")
+
+	return {
+		"success": True,
+		"request_id": request_id,
+		"lotes": len(lotes),
+		"document_count": len(documents)
+	}
+
+
+def split_into_lotes(documents):
+	"""Agrupa los documentos por tipo y los divide en lotes de hasta LOTE_SIZE"""
+
+	by_type = {}
+	for doc_info in documents:
+		by_type.setdefault(doc_info['doctype'], []).append(doc_info)
+
+	lotes = []
+	for docs in by_type.values():
+		for i in range(0, len(docs), LOTE_SIZE):
+			lotes.append(docs[i:i + LOTE_SIZE])
+
+	return lotes
+
+
+def enqueue_on_submit(doc, method=None):
+	"""doc_event on_submit de Sales Invoice: encola la factura para su envío
+
+	Solo si está activado `auto_enqueue_on_submit`. Los documentos se juntan
+	en la cola y `flush_auto_queue` los envía en lotes completos, o cuando
+	pasan `auto_batch_wait_seconds` desde que se emitió el más antiguo.
+	"""
+
+	try:
+		settings = get_facturasend_settings()
+	except frappe.ValidationError:
+		# Sin configuración no se bloquea la emisión de la factura
+		return
+
+	if not settings.auto_enqueue_on_submit:
+		return
+
+	document_type = get_document_type(doc)
+	wait_seconds = cint(settings.auto_batch_wait_seconds) or DEFAULT_AUTO_BATCH_WAIT
+
+	enqueue_for_send(
+		[{"doctype": document_type, "name": doc.name}],
+		next_attempt=add_to_date(now_datetime(), seconds=wait_seconds),
+		commit=False
+	)
+
+	# Un solo job por tipo de documento junta los que se emiten mientras espera
+	frappe.enqueue(
+		"facturasend_integration.facturasend_integration.jobs.flush_auto_queue",
+		queue="long",
+		job_id=f"facturasend_auto_flush:{document_type}",
+		deduplicate=True,
+		enqueue_after_commit=True,
+		document_type=document_type
+	)
+
+
+def flush_auto_queue(document_type):
+	"""Job en segundo plano: envía los documentos pendientes de un tipo
+
+	Revisa la cola cada segundo y envía en cuanto se junta un lote completo o
+	vence la espera del documento más antiguo. Solo toma documentos recién
+	emitidos que esperan dentro de `auto_batch_wait_seconds`; los reintentos
+	respetan su espera y los toma el envío programado. Termina cuando no
+	quedan documentos así sin enviar; los que lleguen después los toma el
+	siguiente job o el envío programado.
+	"""
+
+	settings = get_facturasend_settings()
+	limit = (cint(settings.max_concurrent_lotes) or 1) * LOTE_SIZE
+	wait_seconds = cint(settings.auto_batch_wait_seconds) or DEFAULT_AUTO_BATCH_WAIT
+	dispatched = set()
+
+	while True:
+		# Terminar la transacción para ver los documentos encolados desde otros procesos
+		frappe.db.commit()
+
+		entries = [
+			entry
+			for entry in get_claimable_entries(
+				QUEUE_PENDING,
+				document_type=document_type,
+				limit=limit,
+				due_before=add_to_date(now_datetime(), seconds=wait_seconds),
+				first_attempt_only=True
+			)
+			if entry.name not in dispatched
+		]
+		if not entries:
+			break
+
+		now = now_datetime()
+		if not any(entry.next_attempt and entry.next_attempt <= now for entry in entries):
+			# Sin espera vencida: enviar solo lotes completos
+			entries = entries[:len(entries) // LOTE_SIZE * LOTE_SIZE]
+
+		if not entries:
+			time.sleep(AUTO_FLUSH_POLL_SECONDS)
+			continue
+
+		dispatched.update(entry.name for entry in entries)
+		documents = [{"doctype": document_type, "name": entry.name} for entry in entries]
+		dispatch_lotes_job(split_into_lotes(documents))
+
+
+def process_send_queue():
+	"""Scheduled job: envía los documentos de la cola cuyo próximo intento venció
+
+	Toma los reintentos automáticos de envíos fallidos y los documentos
+	encolados cuyo job de envío no llegó a ejecutarse. Antes pasa a Error los
+	envíos que quedaron interrumpidos.
+	"""
+
+	fail_interrupted_sends()
+
+	settings = get_facturasend_settings()
+	entries = get_claimable_entries(QUEUE_PENDING, limit=(cint(settings.max_concurrent_lotes) or 1) * LOTE_SIZE)
+	if not entries:
+		return
+
+	documents = [{"doctype": entry.document_type, "name": entry.name} for entry in entries]
+	dispatch_lotes_job(split_into_lotes(documents))
+
+
+def dispatch_lotes_job(lotes, request_id=None, first_lote=1, total_lotes=None):
+	"""Job en segundo plano: envía los lotes con varios en vuelo a la vez
+
+	Mantiene hasta `max_concurrent_lotes` (FacturaSend Settings) envíos HTTP
+	en paralelo en un pool de hilos. La conversión, la actualización de los
+	documentos y el aviso de avance se hacen en el hilo del job, porque usan
+	la base de datos; los hilos solo hacen el POST a lote/create. El ritmo
+	total lo marca el limitador de solicitudes del cliente HTTP. El avance se
+	publica solo si hay `request_id` (envíos iniciados por un usuario); si el
+	envío se repartió en varios jobs, `first_lote` y `total_lotes` ubican estos
+	lotes en el total.
+	"""
+
+	settings = get_facturasend_settings()
+	client = get_client()
+	max_in_flight = cint(settings.max_concurrent_lotes) or 1
+	total_lotes = total_lotes or len(lotes)
+	pending = list(enumerate(lotes, first_lote))
+	in_flight = {}
+
+	with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+		while pending or in_flight:
+			while pending and len(in_flight) < max_in_flight:
+				lote_number, documents = pending.pop(0)
+				lote, result = start_lote(executor, client, settings, documents, owned_by=request_id)
+
+				if not result:
+					in_flight[lote.future] = (lote_number, documents, lote)
+				elif request_id:
+					publish_send_progress(request_id, lote_number, total_lotes, documents, result)
+
+			if not in_flight:
+				continue
+
+			done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+			for future in done:
+				lote_number, documents, lote = in_flight.pop(future)
+				result = finish_lote(lote, future.result(), lote_number, total_lotes)
+				if request_id:
+					publish_send_progress(request_id, lote_number, total_lotes, documents, result)
+
+	get_logger().info(f"Envío {request_id or 'programado'}: {len(lotes)} de {total_lotes} lotes procesados")
+
+
+def start_lote(executor, client, settings, documents, owned_by=None):
+	"""Prepara un lote y lanza su envío en el pool
+
+	`owned_by` es el dueño de la reserva de los documentos (el `request_id`
+	de `enqueue_documents`). Retorna `(lote, None)` con el envío en curso en `lote.future`, o
+	`(None, resultado)` si no hay nada que enviar.
+	"""
+
+	if not client:
+		return None, {"success": False, "error": "API Key no configurado en FacturaSend Settings"}
+
+	try:
+		lote = prepare_lote(documents, settings, owned_by=owned_by)
+	except Exception as e:
+		frappe.log_error(frappe.get_traceback(), "FacturaSend - Error al preparar lote")
+		return None, {"success": False, "error": str(e)}
+
+	if not lote.batch_data:
+		return None, complete_empty_lote(lote)
+
+	log_lote_request(client, lote.batch_data)
+	lote.future = executor.submit(post_lote, client, lote.batch_data)
+
+	return lote, None
+
+
+def finish_lote(lote, response, lote_number, total_lotes):
+	"""Registra la respuesta de un lote y actualiza sus documentos"""
+
+	log_lote_response(response)
+
+	try:
+		return complete_lote(lote, response)
+	except Exception as e:
+		frappe.db.rollback()
+		frappe.log_error(frappe.get_traceback(), f"FacturaSend - Error en lote {lote_number}/{total_lotes}")
+		return {"success": False, "error": str(e)}
+
+
+def publish_send_progress(request_id, lote_number, total_lotes, documents, result):
+	"""Publica el resultado de un lote junto con el avance total del envío"""
+
+	cache = frappe.cache()
+	key = cache.make_key(f"facturasend_send_progress:{request_id}")
+	completed = cache.incr(key)
+	cache.expire(key, PROGRESS_TTL)
+
+	frappe.publish_realtime(SEND_PROGRESS_EVENT, {
+		"request_id": request_id,
+		"lote_number": lote_number,
+		"total_lotes": total_lotes,
+		"completed_lotes": completed,
+		"document_count": len(documents),
+		"success": result.get('success'),
+		"error": result.get('error'),
+		"details": result.get('details'),
+		"lote_id": result.get('lote_id'),
+		"cdcs": result.get('cdcs', [])
+	}, user=frappe.session.user)
@@ -0,0 +1,476 @@
+# Copyright (c) 2025, Luis and contributors
+# For license information, please see license.txt
+
+import json
+import os
+import shutil
+import tempfile
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import frappe
+from frappe.utils import add_to_date, cint, now_datetime
+from facturasend_integration.facturasend_integration.client import get_client
+from facturasend_integration.facturasend_integration.logger import get_logger
+from facturasend_integration.facturasend_integration.settings import get_facturasend_settings
+
+try:
+	from pypdf import PdfWriter as PdfMerger
+except ImportError:
+	# Frappe v14
+	from PyPDF2 import PdfMerger
+
+
+# Formato de KUDE que se pide a FacturaSend
+KUDE_FORMAT = "a4"
+
+# Bytes que se escriben a disco por vez al descargar un PDF
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+# Prefijo de los archivos de KUDE en private/files
+KUDE_FILE_PREFIX = "kude-"
+
+# Horas que se conservan las descargas de varios documentos (no adjuntas)
+DOWNLOAD_TTL_HOURS = 24
+
+# Carpeta del sitio con los KUDEs por documento, fuera de private/files
+KUDE_CACHE_FOLDER = "kude_cache"
+
+# Tamaño máximo por defecto del caché de KUDEs en MB
+DEFAULT_KUDE_CACHE_MB = 500
+
+# Al superar el máximo se borran los menos usados hasta quedar en esta fracción
+KUDE_CACHE_TARGET_RATIO = 0.9
+
+# Descargas simultáneas por defecto a /de/pdf
+DEFAULT_KUDE_CONCURRENCY = 4
+
+# Evento realtime con el avance de una descarga de KUDEs en segundo plano
+KUDE_PROGRESS_EVENT = "facturasend_kude_progress"
+
+# Minutos desde el último uso en que un KUDE del caché no se borra: otro
+# worker puede estar armando una descarga con él
+KUDE_IN_USE_MINUTES = 30
+
+# Formatos de salida de una descarga de varios documentos
+KUDE_OUTPUTS = ("pdf", "zip")
+
+# KUDEs por PDF unido: pypdf tiene en memoria todas las páginas hasta escribir,
+# así que las descargas más grandes se arman como ZIP de PDFs de este tamaño
+MERGE_MAX_DOCUMENTS = 100
+
+
+def get_kude_file(cdcs, attach_to=None, output="pdf", names=None, on_progress=None):
+	"""Arma los KUDEs de `cdcs` en un solo archivo y lo guarda como File privado
+
+	Cada KUDE se toma del caché local por (CDC, formato); a la API solo se
+	piden los que faltan, varios a la vez, y se guardan en el caché. Con
+	`output="zip"` se arma un ZIP con un PDF por documento, nombrados según
+	`names` ({cdc: nombre}). Con `attach_to` (nombre de Sales Invoice) el
+	archivo queda adjunto a la factura, reemplazando el KUDE adjuntado antes.
+	Un PDF de más de `MERGE_MAX_DOCUMENTS` documentos se entrega como ZIP de
+	PDFs unidos de a `MERGE_MAX_DOCUMENTS`. El caché se limita recién con el archivo armado, sin borrar los KUDEs de
+	`cdcs`. Retorna la URL de descarga en `file_url` y `pdf_url`.
+	"""
+
+	paths = [get_kude_cache_path(cdc) for cdc in cdcs]
+
+	result = fill_kude_cache(cdcs, on_progress=on_progress)
+	if not result['success']:
+		evict_kude_cache(keep=paths)
+		return result
+
+	merge_in_parts = output == "pdf" and len(paths) > MERGE_MAX_DOCUMENTS
+	if merge_in_parts:
+		output = "zip"
+
+	# Marcar como en uso justo antes de armar: el LRU de otros workers no los borra
+	touch_kude_cache(paths)
+
+	file_name = f"{KUDE_FILE_PREFIX}{frappe.generate_hash(length=16)}.{output}"
+	path = frappe.get_site_path("private", "files", file_name)
+	names = names or {}
+
+	if merge_in_parts:
+		write_merged_zip(cdcs, paths, names, path)
+	elif output == "zip":
+		write_zip({f"KUDE_{names.get(cdc) or cdc}.pdf": piece for cdc, piece in zip(cdcs, paths)}, path)
+	else:
+		merge_pdfs(paths, path)
+
+	evict_kude_cache(keep=paths)
+
+	get_logger().debug(f"KUDE de {len(cdcs)} CDCs guardado en {file_name} ({result['fetched']} descargados de FacturaSend)")
+
+	file_doc = create_kude_file(path, attach_to)
+
+	return {
+		"success": True,
+		"file_name": file_doc.file_name,
+		"file_url": file_doc.file_url,
+		"pdf_url": file_doc.file_url
+	}
+
+
+def fill_kude_cache(cdcs, kude_format=KUDE_FORMAT, on_progress=None):
+	"""Descarga al caché los KUDEs de `cdcs` que todavía no están
+
+	Los que ya están se marcan como usados (para el LRU). Si todos están en el
+	caché no se usa la red. Los que faltan se piden de a uno, hasta
+	`kude_max_concurrent` a la vez; un error en un documento no corta la
+	descarga de los demás. `on_progress(listos, total)` se llama en el hilo
+	actual a medida que terminan. No limita el tamaño del caché: eso queda
+	para quien usa los archivos (ver `evict_kude_cache`). Retorna la cantidad
+	descargada en `fetched`.
+	"""
+
+	cdcs = list(dict.fromkeys(cdcs))
+	missing = {}
+	for cdc in cdcs:
+		path = get_kude_cache_path(cdc, kude_format)
+		if not touch_kude_cache([path]):
+			missing[cdc] = path
+
+	done = len(cdcs) - len(missing)
+	if on_progress:
+		on_progress(done, len(cdcs))
+
+	if not missing:
+		return {"success": True, "fetched": 0}
+
+	client = get_client()
+	if not client:
+		return {"success": False, "error": "API Key no configurado"}
+
+	get_logger().debug(f"POST {client.api_root}/de/pdf para {len(missing)} CDCs fuera del caché")
+
+	errors = []
+	max_workers = cint(get_facturasend_settings().kude_max_concurrent) or DEFAULT_KUDE_CONCURRENCY
+	with ThreadPoolExecutor(max_workers=min(max_workers, len(missing))) as executor:
+		futures = {
+			executor.submit(fetch_kude_pdf, client, [cdc], path, kude_format): cdc
+			for cdc, path in missing.items()
+		}
+
+		for future in as_completed(futures):
+			try:
+				result = future.result()
+			except Exception as e:
+				result = {"success": False, "error": str(e)}
+
+			if not result['success']:
+				get_logger().warning(f"Error descargando KUDE {futures[future]}: {result['error'][:500]}")
+				errors.append(result['error'])
+
+			done += 1
+			if on_progress:
+				on_progress(done, len(cdcs))
+
+	if errors:
+		return {"success": False, "error": errors[0], "fetched": len(missing) - len(errors)}
+
+	return {"success": True, "fetched": len(missing)}
+
+
+@frappe.whitelist()
+def enqueue_kude_download(documents=None, cdcs=None, output="pdf"):
+	"""Encola la descarga de los KUDEs de muchos documentos
+
+	Recibe `documents` ([{"doctype", "name"}]) o directamente `cdcs`. El
+	archivo (un PDF único o un ZIP con un PDF por documento) se arma en un job
+	en segundo plano que informa el avance con el evento realtime
+	`facturasend_kude_progress`; el último evento trae `file_url`.
+	"""
+
+	if isinstance(documents, str):
+		documents = json.loads(documents)
+	if isinstance(cdcs, str):
+		cdcs = json.loads(cdcs)
+
+	if output not in KUDE_OUTPUTS:
+		return {"success": False, "error": f"Formato no soportado: {output}"}
+
+	if documents:
+		cdcs = list(get_document_cdcs([doc_info['name'] for doc_info in documents]).values())
+
+	if not cdcs:
+		return {"success": False, "error": "Los documentos seleccionados no tienen CDC"}
+
+	request_id = frappe.generate_hash(length=12)
+	frappe.enqueue(
+		"facturasend_integration.facturasend_integration.kude.kude_download_job",
+		queue="long",
+		enqueue_after_commit=True,
+		cdcs=cdcs,
+		output=output,
+		request_id=request_id
+	)
+
+	return {"success": True, "request_id": request_id, "document_count": len(cdcs)}
+
+
+def kude_download_job(cdcs, output, request_id):
+	"""Job en segundo plano: arma la descarga de KUDEs y publica el avance"""
+
+	def publish(data):
+		frappe.publish_realtime(KUDE_PROGRESS_EVENT, dict(data, request_id=request_id), user=frappe.session.user)
+
+	def on_progress(done, total):
+		publish({"done": done, "total": total})
+
+	names = {cdc: name for name, cdc in get_document_cdcs(cdcs=cdcs).items()}
+
+	try:
+		result = get_kude_file(cdcs, output=output, names=names, on_progress=on_progress)
+	except Exception as e:
+		frappe.log_error(frappe.get_traceback(), "FacturaSend - Error armando descarga de KUDEs")
+		result = {"success": False, "error": str(e)}
+
+	publish(dict(result, finished=True, total=len(cdcs)))
+
+
+def get_document_cdcs(names=None, cdcs=None):
+	"""CDC de cada factura, {nombre: cdc}, buscando por nombres o por CDCs
+
+	Por nombres se respeta el orden recibido y se omiten las facturas sin CDC.
+	"""
+
+	si = frappe.qb.DocType("Sales Invoice")
+	query = frappe.qb.from_(si).select(si.name, si.facturasend_cdc)
+
+	if names is not None:
+		rows = dict(query.where(si.name.isin(names or [""])).where(si.facturasend_cdc.isnotnull()).run())
+		return {name: rows[name] for name in names if rows.get(name)}
+
+	return dict(query.where(si.facturasend_cdc.isin(cdcs or [""])).run())
+
+
+def enqueue_kude_prefetch(cdcs):
+	"""Encola la descarga al caché de los KUDEs de documentos recién aprobados
+
+	Así la descarga del usuario se sirve desde disco. Se puede desactivar con
+	`prefetch_kudes` en FacturaSend Settings.
+	"""
+
+	if not cdcs or not get_facturasend_settings().prefetch_kudes:
+		return
+
+	frappe.enqueue(
+		"facturasend_integration.facturasend_integration.kude.prefetch_kudes",
+		queue="long",
+		enqueue_after_commit=True,
+		cdcs=list(cdcs)
+	)
+
+
+def prefetch_kudes(cdcs):
+	"""Job en segundo plano: guarda en el caché los KUDEs de `cdcs`"""
+
+	result = fill_kude_cache(cdcs)
+	evict_kude_cache()
+
+	get_logger().info(f"KUDEs precargados: {result.get('fetched', 0)} de {len(cdcs)} documentos aprobados")
+
+
+def get_kude_cache_path(cdc, kude_format=KUDE_FORMAT):
+	"""Ruta del KUDE de un CDC en el caché local"""
+
+	folder = frappe.get_site_path("private", KUDE_CACHE_FOLDER)
+	os.makedirs(folder, exist_ok=True)
+
+	return os.path.join(folder, f"{cdc}-{kude_format}.pdf")
+
+
+def touch_kude_cache(paths):
+	"""Registra el uso de KUDEs del caché; retorna False si alguno no está"""
+
+	found = True
+	for path in paths:
+		try:
+			os.utime(path)
+		except FileNotFoundError:
+			found = False
+
+	return found
+
+
+def evict_kude_cache(keep=()):
+	"""Borra los KUDEs menos usados si el caché supera su tamaño máximo
+
+	El uso se registra en la fecha de modificación de cada archivo. Las rutas
+	de `keep` (los KUDEs de una descarga en curso) y los KUDEs usados en los
+	últimos `KUDE_IN_USE_MINUTES` (descargas en curso en otros workers) nunca
+	se borran.
+	"""
+
+	max_bytes = (cint(get_facturasend_settings().kude_cache_max_mb) or DEFAULT_KUDE_CACHE_MB) * 1024 * 1024
+	folder = frappe.get_site_path("private", KUDE_CACHE_FOLDER)
+
+	entries = [entry for entry in os.scandir(folder) if entry.is_file() and entry.name.endswith(".pdf")]
+	total = sum(entry.stat().st_size for entry in entries)
+	if total <= max_bytes:
+		return
+
+	target = max_bytes * KUDE_CACHE_TARGET_RATIO
+	in_use_since = time.time() - KUDE_IN_USE_MINUTES * 60
+	keep = set(keep)
+	evicted = 0
+	for entry in sorted(entries, key=lambda entry: entry.stat().st_mtime):
+		if total <= target or entry.stat().st_mtime >= in_use_since:
+			break
+		if entry.path in keep:
+			continue
+		try:
+			# Releer la fecha: otro worker pudo tomarlo después de listar la carpeta
+			if os.stat(entry.path).st_mtime >= in_use_since:
+				continue
+			os.remove(entry.path)
+			evicted += 1
+		except FileNotFoundError:
+			# Ya lo borró otro worker
+			pass
+		total -= entry.stat().st_size
+
+	get_logger().info(f"Caché de KUDEs: {evicted} archivos borrados por tamaño")
+
+
+def merge_pdfs(paths, output_path):
+	"""Une los PDFs de `paths` en `output_path` (copia directa si es uno solo)"""
+
+	if len(paths) == 1:
+		shutil.copyfile(paths[0], output_path)
+		return
+
+	merger = PdfMerger()
+	try:
+		for path in paths:
+			merger.append(path)
+		merger.write(output_path)
+	finally:
+		merger.close()
+
+
+def write_zip(files, output_path):
+	"""Escribe un ZIP con `files` ({nombre: ruta}) leyendo cada archivo desde disco"""
+
+	with zipfile.ZipFile(output_path, "w", compression=zipfile.ZIP_DEFLATED) as zf:
+		for arcname, path in files.items():
+			zf.write(path, arcname)
+
+
+def write_merged_zip(cdcs, paths, names, output_path):
+	"""Escribe un ZIP con los KUDEs unidos en PDFs de hasta `MERGE_MAX_DOCUMENTS`
+
+	Cada parte se une en un archivo temporal, se agrega al ZIP y se borra
+	antes de unir la siguiente, así la memoria no crece con la descarga.
+	"""
+
+	with zipfile.ZipFile(output_path, "w", compression=zipfile.ZIP_DEFLATED) as zf:
+		for start in range(0, len(paths), MERGE_MAX_DOCUMENTS):
+			part_cdcs = cdcs[start:start + MERGE_MAX_DOCUMENTS]
+			first, last = (names.get(cdc) or cdc for cdc in (part_cdcs[0], part_cdcs[-1]))
+
+			fd, part_path = tempfile.mkstemp(dir=os.path.dirname(output_path), suffix=".part")
+			os.close(fd)
+			try:
+				merge_pdfs(paths[start:start + MERGE_MAX_DOCUMENTS], part_path)
+				zf.write(part_path, f"KUDE_{first}_a_{last}.pdf")
+			finally:
+				os.remove(part_path)
+
+
+def fetch_kude_pdf(client, cdcs, path, kude_format=KUDE_FORMAT):
+	"""POST a /de/pdf guardando la respuesta en `path` por bloques
+
+	Escribe primero a un archivo temporal propio (otro worker puede estar
+	bajando el mismo CDC) y lo renombra al terminar, así nunca queda un PDF a
+	medias. No usa frappe, por lo que puede ejecutarse en hilos.
+	"""
+
+	payload = {
+		# Lista de objetos con propiedad "cdc"
+		"cdcList": [{"cdc": cdc} for cdc in cdcs],
+		"format": kude_format
+	}
+
+	response = client.post("de/pdf", payload, stream=True)
+
+	try:
+		if response.status_code != 200:
+			return {"success": False, "error": f"Error al descargar KUDEs: {response.text}"}
+
+		# Los errores vienen como JSON; el PDF viene como binario
+		if 'application/json' in response.headers.get('Content-Type', ''):
+			try:
+				error_msg = response.json().get('error', 'Error desconocido')
+			except ValueError:
+				error_msg = f"La respuesta no es un PDF válido: {response.text[:200]}"
+			return {"success": False, "error": error_msg}
+
+		size = 0
+		fd, part_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=f"{os.path.basename(path)}.", suffix=".part")
+		try:
+			with os.fdopen(fd, "wb") as f:
+				for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+					f.write(chunk)
+					size += len(chunk)
+
+			if not size:
+				return {"success": False, "error": "FacturaSend retornó un PDF vacío"}
+
+			os.replace(part_path, path)
+			return {"success": True, "size": size}
+		finally:
+			if os.path.exists(part_path):
+				os.remove(part_path)
+
+	finally:
+		response.close()
+
+
+def create_kude_file(path, attach_to=None):
+	"""Registra como File privado un PDF ya guardado en private/files"""
+
+	file_name = os.path.basename(path)
+
+	if attach_to:
+		# Un solo KUDE adjunto por factura
+		for name in frappe.get_all("File", filters={
+			"attached_to_doctype": "Sales Invoice",
+			"attached_to_name": attach_to,
+			"file_url": ["like", f"/private/files/{KUDE_FILE_PREFIX}%"]
+		}, pluck="name"):
+			frappe.delete_doc("File", name, ignore_permissions=True)
+
+	file_doc = frappe.get_doc({
+		"doctype": "File",
+		"file_name": f"KUDE_{attach_to}.pdf" if attach_to else file_name,
+		"file_url": f"/private/files/{file_name}",
+		"is_private": 1,
+		"file_size": os.path.getsize(path),
+		"attached_to_doctype": "Sales Invoice" if attach_to else None,
+		"attached_to_name": attach_to
+	})
+	file_doc.insert(ignore_permissions=True)
+
+	return file_doc
+
+
+def delete_old_kude_files():
+	"""Scheduled job: borra las descargas de KUDEs de varios documentos ya viejas
+
+	Los KUDEs adjuntos a una factura se conservan.
+	"""
+
+	files = frappe.get_all("File", filters={
+		"file_url": ["like", f"/private/files/{KUDE_FILE_PREFIX}%"],
+		"attached_to_name": ["is", "not set"],
+		"creation": ["<", add_to_date(now_datetime(), hours=-DOWNLOAD_TTL_HOURS)]
+	}, pluck="name")
+
+	for name in files:
+		frappe.delete_doc("File", name, ignore_permissions=True)
+
+	if files:
+		get_logger().info(f"Descargas de KUDEs borradas: {len(files)}")
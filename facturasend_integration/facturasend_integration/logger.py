@@ -0,0 +1,41 @@
+# Copyright (c) 2025, Luis and contributors
+# For license information, please see license.txt
+
+import logging
+
+import frappe
+from facturasend_integration.facturasend_integration.settings import get_facturasend_settings
+
+
+# Niveles configurables en FacturaSend Settings
+LOG_LEVELS = {
+	"Debug": logging.DEBUG,
+	"Info": logging.INFO,
+	"Warning": logging.WARNING,
+	"Error": logging.ERROR
+}
+
+DEFAULT_LOG_LEVEL = "Info"
+
+
+def get_logger():
+	"""Logger de la integración
+
+	Escribe en el archivo rotativo `facturasend.log` de la carpeta logs del
+	bench y del sitio, con el nivel configurado en FacturaSend Settings.
+	Los mensajes de seguimiento van acá; Error Log queda solo para fallas reales.
+	"""
+
+	logger = frappe.logger("facturasend", allow_site=True, max_size=5_000_000, file_count=5)
+	logger.setLevel(LOG_LEVELS.get(get_log_level(), logging.INFO))
+
+	return logger
+
+
+def get_log_level():
+	"""Nivel de log configurado, sin fallar si aún no hay configuración"""
+
+	try:
+		return get_facturasend_settings().log_level or DEFAULT_LOG_LEVEL
+	except frappe.ValidationError:
+		return DEFAULT_LOG_LEVEL
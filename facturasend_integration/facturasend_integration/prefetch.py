@@ -0,0 +1,209 @@
+# Copyright (c) 2025, Luis and contributors
+# For license information, please see license.txt
+
+import pickle
+
+import frappe
+from facturasend_integration.facturasend_integration.taxes import bump_catalog_version, get_catalog_version, get_iva_table
+
+
+# Columnas necesarias para convertir documentos a FacturaSend
+CUSTOMER_FIELDS = [
+	"name", "customer_name", "modified", "facturasend_contribuyente", "facturasend_ruc",
+	"facturasend_nombre_fantasia", "facturasend_tipo_operacion", "facturasend_tipo_contribuyente",
+	"facturasend_documento_tipo", "facturasend_documento_numero", "facturasend_departamento",
+	"facturasend_departamento_desc", "facturasend_distrito", "facturasend_distrito_desc",
+	"facturasend_ciudad", "facturasend_ciudad_desc", "facturasend_numero_casa",
+	"facturasend_pais", "facturasend_pais_desc"
+]
+
+CONTACT_FIELDS = ["name", "modified", "phone", "mobile_no", "email_id", "is_primary_contact"]
+
+ADDRESS_FIELDS = ["name", "modified", "address_line1", "address_line2", "is_primary_address"]
+
+USER_FIELDS = [
+	"name", "modified", "full_name", "facturasend_documento_tipo", "facturasend_documento_numero",
+	"facturasend_cargo"
+]
+
+ITEM_FIELDS = ["name", "facturasend_ncm", "facturasend_barcode", "facturasend_unidad_medida"]
+
+# Hash de Redis con los datos de FacturaSend de cada Item, por código
+ITEM_CACHE_KEY = "facturasend_item_data"
+
+
+def prefetch_conversion_data(docs):
+	"""Precarga los datos relacionados de un lote de documentos para la conversión
+
+	Reúne todos los clientes, usuarios e items del lote y los resuelve con una
+	consulta IN (...) por DocType, leyendo solo las columnas necesarias.
+	Retorna un diccionario con los datos indexados por nombre.
+	"""
+
+	customer_names = {doc.customer for doc in docs if doc.customer}
+	user_names = {doc.owner for doc in docs if doc.owner}
+	item_codes = {item.item_code for doc in docs for item in doc.items if item.item_code}
+
+	return frappe._dict({
+		"customers": get_records_by_name("Customer", customer_names, CUSTOMER_FIELDS),
+		"contacts": get_linked_records("Contact", customer_names, CONTACT_FIELDS, "is_primary_contact"),
+		"addresses": get_linked_records("Address", customer_names, ADDRESS_FIELDS, "is_primary_address"),
+		"users": get_records_by_name("User", user_names, USER_FIELDS),
+		"item_records": get_items(item_codes),
+		"iva_table": get_iva_table(),
+		"catalog_version": get_catalog_version()
+	})
+
+
+def get_records_by_name(doctype, names, fields):
+	"""Obtiene registros de un DocType por nombre en una sola consulta"""
+
+	if not names:
+		return {}
+
+	records = frappe.get_all(doctype,
+		filters={"name": ["in", list(names)]},
+		fields=fields
+	)
+
+	return {record.name: record for record in records}
+
+
+def get_linked_records(doctype, customer_names, fields, primary_field):
+	"""Obtiene el Contact o Address principal de cada cliente
+
+	Resuelve los Dynamic Link de todos los clientes en una consulta y los
+	registros vinculados en otra. Si un cliente tiene varios, se prefiere el
+	marcado como principal.
+	"""
+
+	if not customer_names:
+		return {}
+
+	links = frappe.get_all("Dynamic Link",
+		filters={
+			"link_doctype": "Customer",
+			"link_name": ["in", list(customer_names)],
+			"parenttype": doctype
+		},
+		fields=["parent", "link_name"],
+		order_by="idx asc"
+	)
+
+	if not links:
+		return {}
+
+	records = get_records_by_name(doctype, {link.parent for link in links}, fields)
+
+	linked = {}
+	for link in links:
+		record = records.get(link.parent)
+		if not record:
+			continue
+
+		current = linked.get(link.link_name)
+		if not current or (record.get(primary_field) and not current.get(primary_field)):
+			linked[link.link_name] = record
+
+	return linked
+
+
+def get_items(item_codes):
+	"""Datos de FacturaSend de cada item, desde el caché compartido en Redis
+
+	Se leen todos con un solo HMGET; los que no están en el caché se leen
+	juntos con `load_items` y se guardan con un solo HSET para las próximas
+	conversiones. Los valores van serializados igual que `hset` de Frappe, así
+	`clear_item_cache` los descarta al guardar, renombrar o borrar el Item.
+	"""
+
+	item_codes = list(dict.fromkeys(item_codes))
+	if not item_codes:
+		return {}
+
+	cache = frappe.cache()
+	key = cache.make_key(ITEM_CACHE_KEY)
+	items = {}
+	missing = []
+
+	for item_code, data in zip(item_codes, cache.execute_command("HMGET", key, *item_codes)):
+		if data is None:
+			missing.append(item_code)
+		else:
+			items[item_code] = pickle.loads(data)
+
+	if missing:
+		loaded = load_items(missing)
+		if loaded:
+			fields = []
+			for item_code, data in loaded.items():
+				fields.extend((item_code, pickle.dumps(data)))
+			cache.execute_command("HSET", key, *fields)
+		items.update(loaded)
+
+	return items
+
+
+def load_items(item_codes):
+	"""Obtiene NCM, unidad de medida, código de barras y plantilla de impuestos de cada item
+
+	El código de barras es el del campo `facturasend_barcode` o, si no tiene,
+	el primero de la tabla Item Barcode. La plantilla es la primera de la
+	tabla de impuestos del Item. Usa tres consultas en total.
+	"""
+
+	items = get_records_by_name("Item", item_codes, ITEM_FIELDS)
+
+	if not items:
+		return items
+
+	barcodes = frappe.get_all("Item Barcode",
+		filters={
+			"parenttype": "Item",
+			"parent": ["in", list(items)]
+		},
+		fields=["parent", "barcode"],
+		order_by="idx asc"
+	)
+
+	for row in barcodes:
+		items[row.parent].setdefault("barcode", row.barcode)
+
+	item_taxes = frappe.get_all("Item Tax",
+		filters={
+			"parenttype": "Item",
+			"parent": ["in", list(items)]
+		},
+		fields=["parent", "item_tax_template"],
+		order_by="idx asc"
+	)
+
+	for row in item_taxes:
+		items[row.parent].setdefault("item_tax_template", row.item_tax_template)
+
+	for item in items.values():
+		if item.facturasend_barcode:
+			item.barcode = item.facturasend_barcode
+
+	return items
+
+
+def clear_item_cache(doc, method=None, old_name=None, *args):
+	"""doc_event de Item: descarta sus datos cacheados
+
+	Los códigos de barras y los impuestos son filas hijas del Item, así que
+	también se invalidan al guardarlo. Al renombrar se descarta también el nombre anterior.
+	"""
+
+	frappe.cache().hdel(ITEM_CACHE_KEY, doc.name)
+	if old_name:
+		frappe.cache().hdel(ITEM_CACHE_KEY, old_name)
+
+	bump_catalog_version()
+
+
+def clear_all_item_cache():
+	"""Descarta los datos de todos los items (p. ej. al cambiar los campos leídos)"""
+
+	frappe.cache().delete_value(ITEM_CACHE_KEY)
+	bump_catalog_version()
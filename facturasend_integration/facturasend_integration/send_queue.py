@@ -0,0 +1,252 @@
+# Copyright (c) 2025, Luis and contributors
+# For license information, please see license.txt
+
+import frappe
+from frappe.query_builder import Case
+from frappe.utils import add_to_date, cint, now_datetime
+
+
+QUEUE_DOCTYPE = "FacturaSend Queue Entry"
+
+# Estados de una entrada de la cola: por enviar, en pleno envío, enviado
+# esperando el estado final, terminado, o con error hasta que se reintente a mano
+QUEUE_PENDING = "Pendiente"
+QUEUE_SENDING = "Enviando"
+QUEUE_POLLING = "Consultando"
+QUEUE_DONE = "Completado"
+QUEUE_ERROR = "Error"
+
+# Segundos que un worker reserva las entradas que tomó
+LEASE_SECONDS = 300
+
+# Segundos tras los cuales un envío sin terminar se da por interrumpido
+SENDING_LEASE_SECONDS = 60 * 60
+
+# Minutos de espera antes de reintentar un envío fallido (se duplica por intento)
+SEND_RETRY_MINUTES = 5
+
+# Filas por UPDATE en las escrituras masivas
+BULK_UPDATE_CHUNK_SIZE = 500
+
+
+def enqueue_for_send(documents, priority=0, next_attempt=None, commit=True, lease_owner=None, lease_seconds=LEASE_SECONDS):
+	"""Deja documentos en la cola como pendientes de envío
+
+	`documents` es una lista de {"doctype": tipo, "name": nombre}. Crea las
+	entradas que falten y vuelve a Pendiente las existentes que no estén
+	reservadas por otro worker ni en pleno envío. `next_attempt` es desde
+	cuándo el envío programado (`process_send_queue`) puede tomarlas; por
+	defecto, ya. Con `lease_owner` quedan reservadas por `lease_seconds` para
+	quien las encola (ver `claim_entries`), y el envío programado no las toma
+	salvo que la reserva venza.
+	"""
+
+	if not documents:
+		return
+
+	now = now_datetime()
+	next_attempt = next_attempt or now
+	lease_expires = add_to_date(now, seconds=lease_seconds) if lease_owner else None
+	types = {doc_info['name']: doc_info['doctype'] for doc_info in documents}
+
+	existing = set(frappe.get_all(QUEUE_DOCTYPE,
+		filters={"name": ["in", list(types)]},
+		pluck="name"
+	))
+
+	missing = [name for name in types if name not in existing]
+	if missing:
+		user = frappe.session.user
+		frappe.db.bulk_insert(QUEUE_DOCTYPE,
+			["name", "sales_invoice", "document_type", "state", "priority", "attempts",
+				"next_attempt", "lease_owner", "lease_expires", "creation", "modified", "owner", "modified_by"],
+			[
+				(name, name, types[name], QUEUE_PENDING, priority, 0, next_attempt, lease_owner, lease_expires, now, now, user, user)
+				for name in missing
+			],
+			ignore_duplicates=True
+		)
+
+	if existing:
+		entry = frappe.qb.DocType(QUEUE_DOCTYPE)
+		(frappe.qb.update(entry)
+			.set(entry.state, QUEUE_PENDING)
+			.set(entry.priority, priority)
+			.set(entry.next_attempt, next_attempt)
+			.set(entry.last_error, None)
+			.set(entry.lease_owner, lease_owner)
+			.set(entry.lease_expires, lease_expires)
+			.where(entry.name.isin(list(existing)))
+			.where(entry.state != QUEUE_SENDING)
+			.where(entry.lease_expires.isnull() | (entry.lease_expires < now))
+		).run()
+
+	if commit:
+		frappe.db.commit()
+
+
+def claim_entries(state, names=None, limit=100, owned_by=None, new_state=None, lease_seconds=LEASE_SECONDS):
+	"""Reserva entradas de la cola para este worker
+
+	Toma hasta `limit` entradas en `state` que no estén reservadas (o que
+	estén reservadas por `owned_by`), por prioridad y antigüedad del próximo
+	intento. Si se indican `names` se toman solo esas, sin mirar el próximo
+	intento. Con `new_state` las entradas pasan a ese estado al reservarlas.
+	La reserva se hace con un UPDATE condicionado y se confirma enseguida,
+	así dos workers nunca toman la misma entrada; vence a los `lease_seconds`
+	si el worker muere.
+	"""
+
+	if names is not None and not names:
+		return []
+
+	candidates = [
+		entry.name
+		for entry in get_claimable_entries(state, names=names, due_only=names is None, limit=limit, owned_by=owned_by)
+	]
+	if not candidates:
+		return []
+
+	now = now_datetime()
+	lease_owner = frappe.generate_hash(length=12)
+	entry = frappe.qb.DocType(QUEUE_DOCTYPE)
+	claimable = entry.lease_expires.isnull() | (entry.lease_expires < now)
+	if owned_by:
+		claimable = claimable | (entry.lease_owner == owned_by)
+
+	query = (frappe.qb.update(entry)
+		.set(entry.lease_owner, lease_owner)
+		.set(entry.lease_expires, add_to_date(now, seconds=lease_seconds))
+		.where(entry.name.isin(candidates))
+		.where(entry.state == state)
+		.where(claimable)
+	)
+	if new_state:
+		query = query.set(entry.state, new_state)
+	query.run()
+	frappe.db.commit()
+
+	return frappe.get_all(QUEUE_DOCTYPE,
+		filters={"name": ["in", candidates], "lease_owner": lease_owner},
+		fields=["name", "document_type", "state", "attempts", "next_attempt"],
+		order_by="priority desc, next_attempt asc"
+	)
+
+
+def get_claimable_entries(state, names=None, document_type=None, due_only=True, limit=100, owned_by=None,
+	due_before=None, first_attempt_only=False):
+	"""Entradas en `state` sin reserva vigente, por prioridad y próximo intento
+
+	Con `due_only` solo se incluyen las que llegan a su próximo intento antes
+	de `due_before` (por defecto, ahora). Con `first_attempt_only` se excluyen
+	los reintentos. Con `owned_by` se incluyen también las reservadas por ese dueño.
+	"""
+
+	now = now_datetime()
+	filters = [[QUEUE_DOCTYPE, "state", "=", state]]
+	or_filters = [
+		# Sin reserva cuenta como vencida
+		[QUEUE_DOCTYPE, "lease_expires", "<", now]
+	]
+	if owned_by:
+		or_filters.append([QUEUE_DOCTYPE, "lease_owner", "=", owned_by])
+
+	if names is not None:
+		filters.append([QUEUE_DOCTYPE, "name", "in", list(names)])
+	if document_type:
+		filters.append([QUEUE_DOCTYPE, "document_type", "=", document_type])
+	if due_only:
+		filters.append([QUEUE_DOCTYPE, "next_attempt", "<=", due_before or now])
+	if first_attempt_only:
+		filters.append([QUEUE_DOCTYPE, "attempts", "=", 0])
+
+	return frappe.get_all(QUEUE_DOCTYPE,
+		filters=filters,
+		or_filters=or_filters,
+		fields=["name", "document_type", "next_attempt"],
+		order_by="priority desc, next_attempt asc",
+		limit_page_length=limit
+	)
+
+
+def release_entries(updates, commit=True):
+	"""Actualiza entradas de la cola y libera su reserva
+
+	`updates` es {nombre: {campo: valor}} con los campos de la entrada
+	(state, attempts, next_attempt, last_error).
+	"""
+
+	if not updates:
+		return
+
+	for values in updates.values():
+		values.setdefault("lease_owner", None)
+		values.setdefault("lease_expires", None)
+
+	bulk_update_records(QUEUE_DOCTYPE, updates)
+
+	if commit:
+		frappe.db.commit()
+
+
+def fail_interrupted_sends():
+	"""Pasa a Error los envíos que quedaron en Enviando (el worker murió)
+
+	No se reintentan solos: el POST pudo haber llegado a FacturaSend, y
+	reenviarlo duplicaría los documentos. Quedan para revisar y reintentar a mano.
+	"""
+
+	now = now_datetime()
+	entry = frappe.qb.DocType(QUEUE_DOCTYPE)
+	(frappe.qb.update(entry)
+		.set(entry.state, QUEUE_ERROR)
+		.set(entry.last_error, "Envío interrumpido: verificar en FacturaSend antes de reintentar")
+		.set(entry.lease_owner, None)
+		.set(entry.lease_expires, None)
+		.where(entry.state == QUEUE_SENDING)
+		.where(entry.lease_expires < now)
+	).run()
+	frappe.db.commit()
+
+
+def get_send_retry(attempts, max_retries):
+	"""Estado y próximo intento de una entrada después de un envío fallido
+
+	Los envíos se reintentan solos con espera creciente hasta `max_retries`;
+	después la entrada queda en Error hasta que se reintente a mano.
+	"""
+
+	if cint(attempts) >= cint(max_retries):
+		return {"state": QUEUE_ERROR, "attempts": attempts}
+
+	return {
+		"state": QUEUE_PENDING,
+		"attempts": attempts,
+		"next_attempt": add_to_date(now_datetime(), minutes=SEND_RETRY_MINUTES * 2 ** (cint(attempts) - 1))
+	}
+
+
+def bulk_update_records(doctype, updates):
+	"""Escribe muchos registros de un DocType en un solo UPDATE por bloque
+
+	`updates` es {nombre: {campo: valor}}. Solo se modifican las columnas
+	indicadas: no se ejecutan validaciones, no se crean versiones y no se
+	toca `modified`.
+	"""
+
+	names = list(updates)
+	table = frappe.qb.DocType(doctype)
+
+	for i in range(0, len(names), BULK_UPDATE_CHUNK_SIZE):
+		chunk = names[i:i + BULK_UPDATE_CHUNK_SIZE]
+		fields = {field for name in chunk for field in updates[name]}
+
+		query = frappe.qb.update(table).where(table.name.isin(chunk))
+		for field in sorted(fields):
+			case = Case()
+			for name in chunk:
+				if field in updates[name]:
+					case = case.when(table.name == name, updates[name][field])
+			query = query.set(table[field], case.else_(table[field]))
+
+		query.run()
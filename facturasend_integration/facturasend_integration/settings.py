@@ -0,0 +1,98 @@
+# Copyright (c) 2025, Luis and contributors
+# For license information, please see license.txt
+
+import time
+
+import frappe
+from frappe import _
+from frappe.utils import cint, flt
+
+
+# Segundos que un worker reutiliza la configuración antes de volver a leerla
+SETTINGS_CACHE_TTL = 300
+
+# Clave en Redis que cambia cada vez que se guarda FacturaSend Settings
+SETTINGS_VERSION_KEY = "facturasend_settings_version"
+
+# Configuración en memoria del worker, por sitio
+_settings_cache = {}
+
+
+def get_facturasend_settings():
+	"""Obtiene la configuración de FacturaSend"""
+
+	return get_settings_entry().settings
+
+
+def get_facturasend_credentials():
+	"""Obtiene las credenciales de FacturaSend ya desencriptadas
+
+	Retorna un diccionario con `api_key`, `api_root` (base URL + tenant),
+	`headers` y los parámetros de conexión listos para usar en las llamadas
+	HTTP. `api_key` y `headers` son None si no hay API Key configurado.
+	"""
+
+	return get_settings_entry().credentials
+
+
+def get_settings_entry():
+	"""Configuración y credenciales cacheadas
+
+	Se guardan por request en frappe.local y por worker en memoria con un TTL.
+	El caché del worker se descarta cuando cambia la versión en Redis, que se
+	actualiza al guardar FacturaSend Settings.
+	"""
+
+	entry = getattr(frappe.local, "facturasend_settings", None)
+	if entry:
+		return entry
+
+	version = frappe.cache().get_value(SETTINGS_VERSION_KEY)
+	entry = _settings_cache.get(frappe.local.site)
+
+	if not entry or entry.version != version or entry.expires < time.monotonic():
+		entry = load_settings_entry(version)
+		_settings_cache[frappe.local.site] = entry
+
+	frappe.local.facturasend_settings = entry
+	return entry
+
+
+def load_settings_entry(version):
+	"""Lee FacturaSend Settings y desencripta el API Key una sola vez"""
+
+	if not frappe.db.exists("FacturaSend Settings", "FacturaSend Settings"):
+		frappe.throw(_("Por favor configure FacturaSend Settings primero"))
+
+	settings = frappe.get_doc("FacturaSend Settings", "FacturaSend Settings")
+	api_key = settings.get_password('api_key', raise_exception=False)
+
+	credentials = frappe._dict({
+		"api_key": api_key,
+		"api_root": f"{settings.base_url}/{settings.tenant_id}",
+		"headers": {
+			"Authorization": f"Bearer {api_key}",
+			"Content-Type": "application/json"
+		} if api_key else None,
+		"connect_timeout": cint(settings.connect_timeout) or 5,
+		"read_timeout": cint(settings.read_timeout) or 30,
+		"compress_requests": bool(settings.compress_requests),
+		"rate_limit": flt(settings.rate_limit_per_second),
+		"rate_burst": cint(settings.rate_limit_burst),
+		"max_concurrent_lotes": cint(settings.max_concurrent_lotes) or 1
+	})
+
+	return frappe._dict({
+		"settings": settings,
+		"credentials": credentials,
+		"version": version,
+		"expires": time.monotonic() + SETTINGS_CACHE_TTL
+	})
+
+
+def clear_settings_cache():
+	"""Invalida la configuración cacheada en este y en los demás workers"""
+
+	_settings_cache.pop(frappe.local.site, None)
+	frappe.local.facturasend_settings = None
+	frappe.cache().set_value(SETTINGS_VERSION_KEY, frappe.generate_hash(length=10))
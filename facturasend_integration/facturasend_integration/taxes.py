@@ -0,0 +1,143 @@
+# Copyright (c) 2025, Luis and contributors
+# For license information, please see license.txt
+
+import frappe
+from frappe import _
+from frappe.utils import flt
+
+
+# Tipos de afectación del IVA de SIFEN
+IVA_GRAVADO = 1
+IVA_EXENTO = 3
+
+# Tasa de IVA de la plantilla de impuestos -> campos del item en FacturaSend
+IVA_BY_RATE = {
+	10: {"ivaTipo": IVA_GRAVADO, "iva": 10, "ivaBase": 100},
+	5: {"ivaTipo": IVA_GRAVADO, "iva": 5, "ivaBase": 100},
+	0: {"ivaTipo": IVA_EXENTO, "iva": 0, "ivaBase": 0}
+}
+
+# Items sin plantilla de impuestos en la factura, el Item ni su grupo
+DEFAULT_IVA = IVA_BY_RATE[10]
+
+# Clave en Redis con la tabla de IVA precalculada
+IVA_TABLE_KEY = "facturasend_iva_table"
+
+# Clave en Redis que cambia cada vez que cambian los datos de items o impuestos
+CATALOG_VERSION_KEY = "facturasend_catalog_version"
+
+
+def get_iva_table():
+	"""Tabla de IVA precalculada, compartida en Redis
+
+	Se arma una sola vez con `build_iva_table` y se descarta al guardar una
+	Item Tax Template o un Item Group (ver `clear_iva_table`).
+	"""
+
+	return frappe.cache().get_value(IVA_TABLE_KEY, generator=build_iva_table)
+
+
+def build_iva_table():
+	"""Arma la tabla de IVA en tres consultas
+
+	Retorna `templates` ({plantilla: campos de IVA, o None si su tasa no es
+	de SIFEN}) e `item_groups` ({grupo: plantilla}), con la plantilla que
+	cada grupo hereda de sus grupos padre ya resuelta.
+	"""
+
+	rates = {}
+	for row in frappe.get_all("Item Tax Template Detail",
+		filters={"parenttype": "Item Tax Template"},
+		fields=["parent", "tax_rate"]
+	):
+		# Una plantilla puede tener varias cuentas; vale la tasa mayor
+		rates[row.parent] = max(rates.get(row.parent, 0), flt(row.tax_rate))
+
+	templates = {
+		name: IVA_BY_RATE.get(rate)
+		for name, rate in rates.items()
+	}
+	for name in frappe.get_all("Item Tax Template", pluck="name"):
+		# Plantillas sin filas: exentas
+		templates.setdefault(name, IVA_BY_RATE[0])
+
+	return {
+		"templates": templates,
+		"item_groups": get_item_group_templates()
+	}
+
+
+def get_item_group_templates():
+	"""Plantilla de impuestos de cada Item Group, heredada de sus padres si no tiene"""
+
+	own = {}
+	for row in frappe.get_all("Item Tax",
+		filters={"parenttype": "Item Group"},
+		fields=["parent", "item_tax_template"],
+		order_by="idx asc"
+	):
+		own.setdefault(row.parent, row.item_tax_template)
+
+	parents = dict(frappe.get_all("Item Group", fields=["name", "parent_item_group"], as_list=True))
+
+	resolved = {}
+	for group in parents:
+		chain = []
+		current = group
+		while current and current not in resolved and current not in own and current not in chain:
+			chain.append(current)
+			current = parents.get(current)
+
+		template = resolved.get(current) or own.get(current)
+		for name in chain:
+			resolved[name] = template
+		if current in own:
+			resolved[current] = own[current]
+
+	return {group: template for group, template in resolved.items() if template}
+
+
+def get_item_iva(item, item_record, iva_table):
+	"""Campos de IVA (`ivaTipo`, `iva`, `ivaBase`) de una fila de la factura
+
+	La plantilla se toma de la fila (ERPNext la completa desde el Item o su
+	grupo al facturar), si no del Item y si no de su Item Group. Sin
+	plantilla se usa IVA 10%.
+	"""
+
+	template = (
+		item.get("item_tax_template")
+		or item_record.get("item_tax_template")
+		or iva_table["item_groups"].get(item.get("item_group"))
+	)
+	if not template:
+		return DEFAULT_IVA
+
+	iva = iva_table["templates"].get(template)
+	if not iva:
+		frappe.throw(_(f"La plantilla de impuestos {template} del item {item.item_code} no tiene una tasa de IVA válida (0, 5 o 10%)"))
+
+	return iva
+
+
+def clear_iva_table(doc=None, method=None, *args):
+	"""doc_event de Item Tax Template e Item Group: descarta la tabla de IVA"""
+
+	frappe.cache().delete_value(IVA_TABLE_KEY)
+	bump_catalog_version()
+
+
+def get_catalog_version():
+	"""Versión actual de los datos de items e impuestos usados en la conversión"""
+
+	return frappe.cache().get_value(CATALOG_VERSION_KEY)
+
+
+def bump_catalog_version():
+	"""Marca como cambiados los datos de items o impuestos
+
+	Invalida los JSON de facturas convertidos antes del cambio (ver
+	`converter.get_cached_payloads`).
+	"""
+
+	frappe.cache().set_value(CATALOG_VERSION_KEY, frappe.generate_hash(length=10))
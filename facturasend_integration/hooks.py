@@ -65,6 +65,7 @@ doctype_js = {
 
 # before_install = "facturasend_integration.install.before_install"
 after_install = "facturasend_integration.install.after_install"
+after_migrate = "facturasend_integration.install.after_migrate"
 
 # Uninstallation
 # ------------
@@ -118,21 +119,38 @@ after_install = "facturasend_integration.install.after_install"
 # ---------------
 # Hook on document methods and events
 
-# doc_events = {
-# 	"*": {
-# 		"on_update": "method",
-# 		"on_cancel": "method",
-# 		"on_trash": "method"
-# 	}
-# }
+doc_events = {
+	"Sales Invoice": {
+		"on_submit": "facturasend_integration.facturasend_integration.jobs.enqueue_on_submit"
+	},
+	"Item": {
+		"on_update": "facturasend_integration.facturasend_integration.prefetch.clear_item_cache",
+		"on_trash": "facturasend_integration.facturasend_integration.prefetch.clear_item_cache",
+		"after_rename": "facturasend_integration.facturasend_integration.prefetch.clear_item_cache"
+	},
+	"Item Tax Template": {
+		"on_update": "facturasend_integration.facturasend_integration.taxes.clear_iva_table",
+		"on_trash": "facturasend_integration.facturasend_integration.taxes.clear_iva_table",
+		"after_rename": "facturasend_integration.facturasend_integration.taxes.clear_iva_table"
+	},
+	"Item Group": {
+		"on_update": "facturasend_integration.facturasend_integration.taxes.clear_iva_table",
+		"on_trash": "facturasend_integration.facturasend_integration.taxes.clear_iva_table",
+		"after_rename": "facturasend_integration.facturasend_integration.taxes.clear_iva_table"
+	}
+}
 
 # Scheduled Tasks
 # ---------------
 
 scheduler_events = {
+	"daily": [
+		"facturasend_integration.facturasend_integration.kude.delete_old_kude_files"
+	],
 	"cron": {
-		"*/5 * * * *": [
-			"facturasend_integration.facturasend_integration.api.check_document_status"
+		"* * * * *": [
+			"facturasend_integration.facturasend_integration.api.check_document_status",
+			"facturasend_integration.facturasend_integration.jobs.process_send_queue"
 		]
 	}
 }
@@ -163,7 +181,7 @@ scheduler_events = {
 # Ignore links to specified DocTypes when deleting documents
 # -----------------------------------------------------------
 
-# ignore_links_on_delete = ["Communication", "ToDo"]
+ignore_links_on_delete = ["FacturaSend Queue Entry"]
 
 # Request Events
 # ----------------
@@ -4,6 +4,10 @@
 import frappe
 import json
 import os
+from frappe.custom.doctype.custom_field.custom_field import create_custom_fields as frappe_create_custom_fields
+from frappe.query_builder.functions import Count
+from frappe.utils import cint, cstr
+from facturasend_integration.facturasend_integration.prefetch import clear_all_item_cache
 
 
 def after_install():
@@ -12,67 +16,203 @@ def after_install():
 	print("Instalando FacturaSend Integration...")
 	
 	# Crear custom fields
+	clear_copied_cdcs()
 	create_custom_fields()
 	
+	# Índices sobre los campos facturasend_*
+	create_indexes()
+	
 	# Crear FacturaSend Settings si no existe
 	create_default_settings()
 	
 	print("FacturaSend Integration instalado exitosamente")
 
 
+# Archivos de fixtures con los custom fields de la app
+FIXTURE_FILES = [
+	"custom_fields_customer.json",
+	"custom_fields_sales_invoice.json",
+	"custom_fields_item.json",
+	"custom_fields_user.json"
+]
+
+# Propiedades de Custom Field que se sincronizan desde los fixtures
+FIELD_PROPERTIES = [
+	"fieldtype", "label", "insert_after", "options", "default", "read_only", "hidden",
+	"allow_on_submit", "no_copy", "reqd", "unique", "description", "collapsible", "length"
+]
+
+# Propiedades numéricas: si no están en el fixture valen 0
+INT_PROPERTIES = {"read_only", "hidden", "allow_on_submit", "no_copy", "reqd", "unique", "collapsible", "length"}
+
+
 def create_custom_fields():
-	"""Crea los custom fields desde los fixtures"""
+	"""Crea o actualiza los custom fields desde los fixtures
 	
-	fixtures_path = frappe.get_app_path("facturasend_integration", "fixtures")
+	Compara los fixtures con los Custom Field existentes (una sola consulta) y
+	solo crea los que faltan y actualiza los que cambiaron. Se aplican con
+	`create_custom_fields` de Frappe, que sincroniza el esquema y limpia el
+	caché una sola vez por DocType en lugar de una vez por campo.
+	"""
+	
+	fixtures = get_fixture_fields()
 	
-	# Lista de archivos de fixtures
-	fixture_files = [
-		"custom_fields_customer.json",
-		"custom_fields_sales_invoice.json",
-		"custom_fields_item.json",
-		"custom_fields_user.json"
-	]
+	if get_duplicate_cdcs():
+		# Frappe no aplica `unique` con valores repetidos y cortaría la migración
+		for field in fixtures.get("Sales Invoice", []):
+			if field['fieldname'] == "facturasend_cdc":
+				field['unique'] = 0
+		
+		message = "Hay facturas con el mismo facturasend_cdc: el CDC queda sin índice único hasta corregirlas"
+		frappe.log_error(message, "FacturaSend - CDC duplicados")
+		print(message)
+	
+	existing = {
+		(field.dt, field.fieldname): field
+		for field in frappe.get_all("Custom Field",
+			filters={"dt": ["in", list(fixtures)]},
+			fields=["dt", "fieldname"] + FIELD_PROPERTIES
+		)
+	}
+	
+	changes = {}
+	created = updated = 0
+	
+	for dt, fields in fixtures.items():
+		for field in fields:
+			current = existing.get((dt, field['fieldname']))
+			
+			if not current:
+				created += 1
+			elif get_field_definition(current) != get_field_definition(field):
+				updated += 1
+			else:
+				continue
+			
+			changes.setdefault(dt, []).append(dict(get_field_definition(field), fieldname=field['fieldname']))
 	
-	for fixture_file in fixture_files:
+	if changes:
+		frappe_create_custom_fields(changes, update=True)
+	
+	frappe.db.commit()
+	print(f"Custom fields: {created} creados, {updated} actualizados")
+
+
+def get_fixture_fields():
+	"""Custom fields de los fixtures agrupados por DocType"""
+	
+	fixtures_path = frappe.get_app_path("facturasend_integration", "fixtures")
+	fields_by_doctype = {}
+	
+	for fixture_file in FIXTURE_FILES:
 		file_path = os.path.join(fixtures_path, fixture_file)
 		
 		if os.path.exists(file_path):
 			with open(file_path, 'r', encoding='utf-8') as f:
-				custom_fields = json.load(f)
-			
-			for field in custom_fields:
-				try:
-					dt = field.get('dt')
-					fieldname = field.get('fieldname')
-					
-					# Verificar si el campo ya existe
-					if not frappe.db.exists('Custom Field', {'dt': dt, 'fieldname': fieldname}):
-						custom_field = frappe.get_doc({
-							'doctype': 'Custom Field',
-							'dt': dt,
-							'fieldname': fieldname,
-							'fieldtype': field.get('fieldtype'),
-							'label': field.get('label'),
-							'insert_after': field.get('insert_after'),
-							'options': field.get('options'),
-							'default': field.get('default'),
-							'read_only': field.get('read_only', 0),
-							'reqd': field.get('reqd', 0),
-							'description': field.get('description'),
-							'collapsible': field.get('collapsible', 0),
-							'length': field.get('length')
-						})
-						custom_field.insert(ignore_permissions=True)
-						print(f"Campo creado: {dt}.{fieldname}")
-					else:
-						print(f"Campo ya existe: {dt}.{fieldname}")
-				
-				except Exception as e:
-					print(f"Error creando campo {dt}.{fieldname}: {str(e)}")
+				for field in json.load(f):
+					fields_by_doctype.setdefault(field['dt'], []).append(field)
+	
+	return fields_by_doctype
+
+
+def get_field_definition(field):
+	"""Propiedades sincronizadas de un campo, normalizadas para compararlas"""
+	
+	return {
+		prop: cint(field.get(prop)) if prop in INT_PROPERTIES else (cstr(field.get(prop)) or None)
+		for prop in FIELD_PROPERTIES
+	}
+
+
+def after_migrate():
+	"""Ejecutar después de cada migrate"""
+	
+	clear_copied_cdcs()
+	create_custom_fields()
+	create_indexes()
+	
+	# Los campos de Item leídos pueden haber cambiado con la actualización
+	clear_all_item_cache()
+
+
+# Índices compuestos de Sales Invoice: nombre -> columnas
+SALES_INVOICE_INDEXES = {
+	# Conteos y filtros por estado de la cola
+	"facturasend_estado_docstatus": ["facturasend_estado", "docstatus"],
+	# Listado de documentos pendientes por tipo y fecha
+	"facturasend_tipo_posting_date": ["docstatus", "is_return", "is_debit_note", "posting_date"]
+}
+
+
+def create_indexes():
+	"""Crea los índices que usan la consulta de estados y los listados de la cola
+	
+	Es idempotente: los índices existentes no se vuelven a crear.
+	"""
+	
+	for index_name, columns in SALES_INVOICE_INDEXES.items():
+		frappe.db.add_index("Sales Invoice", columns, index_name)
 	
 	frappe.db.commit()
 
 
+def clear_copied_cdcs():
+	"""Pasa a NULL los CDC vacíos y los copiados de otra factura
+	
+	El CDC es único (ver el fixture), pero antes el campo se copiaba al
+	enmendar, duplicar o crear una nota de crédito. De cada CDC repetido se
+	conserva la factura que lo recibió (validada, no devolución, no enmienda,
+	la más antigua) y se borra en las copias canceladas, las devoluciones y
+	las enmiendas. Corre antes de sincronizar los custom fields.
+	"""
+	
+	if not frappe.db.has_column("Sales Invoice", "facturasend_cdc"):
+		return
+	
+	si = frappe.qb.DocType("Sales Invoice")
+	frappe.qb.update(si).set(si.facturasend_cdc, None).where(si.facturasend_cdc == "").run()
+	
+	duplicates = get_duplicate_cdcs()
+	if duplicates:
+		copies = {}
+		for row in frappe.get_all("Sales Invoice",
+			filters={"facturasend_cdc": ["in", duplicates]},
+			fields=["name", "facturasend_cdc", "docstatus", "is_return", "amended_from", "creation"],
+			order_by="creation asc"
+		):
+			copies.setdefault(row.facturasend_cdc, []).append(row)
+		
+		cleared = []
+		for rows in copies.values():
+			rows.sort(key=lambda row: (row.docstatus != 1, cint(row.is_return), bool(row.amended_from)))
+			cleared.extend(
+				row.name
+				for row in rows[1:]
+				if row.docstatus == 2 or row.is_return or row.amended_from
+			)
+		
+		if cleared:
+			frappe.qb.update(si).set(si.facturasend_cdc, None).where(si.name.isin(cleared)).run()
+			print(f"CDC copiado borrado en {len(cleared)} facturas")
+	
+	frappe.db.commit()
+
+
+def get_duplicate_cdcs():
+	"""CDCs que tiene más de una factura"""
+	
+	if not frappe.db.has_column("Sales Invoice", "facturasend_cdc"):
+		return []
+	
+	si = frappe.qb.DocType("Sales Invoice")
+	return (frappe.qb.from_(si)
+		.select(si.facturasend_cdc)
+		.where(si.facturasend_cdc.isnotnull())
+		.groupby(si.facturasend_cdc)
+		.having(Count("*") > 1)
+	).run(pluck=True)
+
+
 def create_default_settings():
 	"""Crea configuración por defecto de FacturaSend Settings"""
 	
@@ -0,0 +1,43 @@
+# Copyright (c) 2025, Luis and contributors
+# For license information, please see license.txt
+
+import frappe
+from frappe.utils import now_datetime
+from facturasend_integration.facturasend_integration.api import STATUS_PENDING_STATES, get_document_type
+from facturasend_integration.facturasend_integration.send_queue import QUEUE_DOCTYPE, QUEUE_POLLING
+
+
+def execute():
+	"""Crea las entradas de la cola de los documentos que esperan su estado
+
+	Antes la cola eran los valores de facturasend_estado en Sales Invoice. Los
+	documentos pendientes de envío no se encolan: se envían a mano como siempre.
+	Todos se consultan en la próxima ejecución de `check_document_status`: los
+	patches corren antes de `after_migrate`, así que los campos nuevos de
+	Sales Invoice (como `facturasend_proxima_consulta`) todavía no existen.
+	"""
+
+	frappe.reload_doc("facturasend_integration", "doctype", "facturasend_queue_entry")
+
+	existing = set(frappe.get_all(QUEUE_DOCTYPE, pluck="name"))
+	invoices = frappe.get_all("Sales Invoice",
+		filters=[
+			["docstatus", "=", 1],
+			["facturasend_estado", "in", STATUS_PENDING_STATES],
+			["facturasend_cdc", "!=", ""]
+		],
+		fields=["name", "is_return", "is_debit_note"]
+	)
+
+	now = now_datetime()
+	frappe.db.bulk_insert(QUEUE_DOCTYPE,
+		["name", "sales_invoice", "document_type", "state", "priority", "attempts",
+			"next_attempt", "creation", "modified", "owner", "modified_by"],
+		[
+			(doc.name, doc.name, get_document_type(doc), QUEUE_POLLING, 0, 0,
+				now, now, now, "Administrator", "Administrator")
+			for doc in invoices
+			if doc.name not in existing
+		],
+		ignore_duplicates=True
+	)